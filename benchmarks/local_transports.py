@@ -0,0 +1,94 @@
+#!/usr/bin/python
+"""Measure request latency to a local stand-in server by transport.
+
+The same stand-in server listens on a TCP port and on a Unix domain socket.
+Requests are made through van_api.API with pooled TCP connections, a new
+TCP connection per request and pooled Unix domain socket connections.
+
+    python benchmarks/local_transports.py [requests]
+"""
+
+import os
+import sys
+import shutil
+import timeit
+import tempfile
+import threading
+import http.client
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# run from a checkout without installing van_api
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import van_api
+
+BODY = '{"url": "/1/locations/1", "title": "Location"}'.encode('ascii')
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class UnixHandler(Handler):
+
+    disable_nagle_algorithm = False
+
+    def address_string(self):
+        return 'unix'
+
+
+def serve(server):
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def make(host, **kw):
+    api = van_api.API(host, logger=None, **kw)
+    api._access_token = {'token_type': 'bearer', 'access_token': 'token'}
+    return api
+
+
+def main():
+    n = 2000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'api.sock')
+        tcp = serve(ThreadingHTTPServer(('127.0.0.1', 0), Handler))
+        unix = serve(socketserver.ThreadingUnixStreamServer(path, UnixHandler))
+        host = '127.0.0.1:%s' % tcp.server_address[1]
+        apis = [
+            ('TCP, pooled', make(host, conn_factory=http.client.HTTPConnection)),
+            ('TCP, new connection', make(host, conn_factory=http.client.HTTPConnection,
+                pool_size=0)),
+            ('Unix socket, pooled', make(host, conn_factory=van_api.UnixSocketTransport(path))),
+            ]
+        for name, api in apis:
+            best = min(timeit.repeat(lambda: api.GET('/1/locations/1'), number=n, repeat=3))
+            print('%-20s %7.1f us/request' % (name, best / n * 1e6))
+            api.close()
+        tcp.shutdown()
+        unix.shutdown()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
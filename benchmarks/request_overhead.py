@@ -0,0 +1,131 @@
+#!/usr/bin/python
+"""Measure the per-request overhead of van_api.API.
+
+Requests go to an in-memory connection, so only the time spent in van_api
+is measured. LegacyAPI re-implements the previous request building,
+status dispatch and header lookup for comparison. LegacyDebugAPI also
+formats the debug messages even if debug logging is disabled, as before.
+The savings of both are reported separately.
+
+    python benchmarks/request_overhead.py [requests]
+"""
+
+import os
+import sys
+import timeit
+import logging
+from pprint import pformat
+
+# run from a checkout without installing van_api
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import van_api
+
+BODY = '{"url": "/1/locations/1", "title": "Location"}'.encode('ascii')
+HEADERS = [('Date', 'Mon, 19 Oct 2026 10:00:00 GMT'),
+        ('Server', 'nginx'),
+        ('Cache-Control', 'no-cache'),
+        ('Content-Length', str(len(BODY))),
+        ('Content-Type', 'application/json')]
+
+
+class Response(object):
+
+    status = 200
+    reason = 'OK'
+
+    def getheaders(self):
+        return HEADERS
+
+    def read(self, amt=None):
+        return BODY
+
+
+class Connection(object):
+
+    def __init__(self, host):
+        pass
+
+    def request(self, method, url, body=None, headers=None):
+        pass
+
+    def getresponse(self):
+        return Response()
+
+    def close(self):
+        pass
+
+
+class LegacyAPI(van_api.API):
+
+    def _get_headers(self, access_token):
+        headers = self.default_headers.copy()
+        if access_token is not None:
+            headers['Authorization'] = self._auth_header(access_token)
+        return headers
+
+    def handle(self, request, response):
+        handler = getattr(self, '_handle_status_%s' % response['status'], self._handle_error)
+        return handler(request, response)
+
+    def _get_header(self, header, headers):
+        header = header.lower()
+        for k, v in headers:
+            if k.lower() == header:
+                return v
+
+
+class LegacyDebugConnection(van_api._HTTPConnection):
+
+    def http(self, method, url, body=None, headers=None, handler=None, http_handler=None, **kw):
+        # debug messages were formatted even if debug logging was disabled
+        if self.logger is not None:
+            pformat(dict(method=method, host=self.host, url=url, body=body, headers=headers))
+        def legacy_http_handler(request, resp):
+            response = (http_handler or van_api._httplib_response_to_dict)(request, resp)
+            if self.logger is not None:
+                pformat(response)
+            return response
+        return van_api._HTTPConnection.http(self, method, url, body, headers,
+                handler, legacy_http_handler, **kw)
+
+
+class LegacyDebugAPI(LegacyAPI):
+
+    def __init__(self, host, logger=logging, **kw):
+        LegacyAPI.__init__(self, host, logger=logger, **kw)
+        self.conn = LegacyDebugConnection(host, logger=logger, conn_factory=Connection)
+
+
+def make(cls, logger):
+    api = cls('apihost', conn_factory=Connection, logger=logger,
+            default_headers={'Cache-Control': 'no-cache'})
+    api._access_token = {'token_type': 'bearer', 'access_token': 'token'}
+    return api
+
+
+def main():
+    n = 20000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    for logger_name, logger in [('logging (INFO)', logging), ('no logger', None)]:
+        print(logger_name)
+        results = {}
+        for cls in [LegacyDebugAPI, LegacyAPI, van_api.API]:
+            api = make(cls, logger)
+            best = min(timeit.repeat(lambda: api.GET('/1/locations/1'), number=n, repeat=3))
+            results[cls] = best / n * 1e6
+            print('  %-14s %7.2f us/request' % (cls.__name__, results[cls]))
+        debug, legacy, new = results[LegacyDebugAPI], results[LegacyAPI], results[van_api.API]
+        # dispatch, header lookup and cached headers
+        print('  %-14s %7.2f us/request (%.0f%%)' % ('dispatch', legacy - new,
+                100 * (legacy - new) / legacy))
+        if logger is not None:
+            # not formatting disabled debug messages
+            print('  %-14s %7.2f us/request (%.0f%%)' % ('debug format', debug - legacy,
+                    100 * (debug - legacy) / debug))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+"""Measure request throughput of one shared API by number of threads.
+
+Every thread makes requests through the same van_api.API to a local
+stand-in server. The stand-in server answers after a fixed delay, as a
+remote server would, so throughput should grow with the number of threads
+until the connection pool (pool_size) is the limit.
+
+    python benchmarks/thread_scaling.py [requests per thread] [delay in ms]
+"""
+
+import os
+import sys
+import time
+import threading
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# run from a checkout without installing van_api
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import van_api
+
+BODY = '{"url": "/1/locations/1", "title": "Location"}'.encode('ascii')
+DELAY = 0.002
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        time.sleep(DELAY)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+def run(api, threads, n):
+    def work():
+        for i in range(n):
+            api.GET('/1/locations/1')
+    workers = [threading.Thread(target=work) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * n / (time.perf_counter() - start)
+
+
+def main():
+    global DELAY
+    n = 200
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        DELAY = float(sys.argv[2]) / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    host = '127.0.0.1:%s' % server.server_address[1]
+    api = van_api.API(host, logger=None, conn_factory=http.client.HTTPConnection, pool_size=16)
+    api._access_token = {'token_type': 'bearer', 'access_token': 'token'}
+    base = None
+    for threads in (1, 2, 4, 8, 16, 32):
+        rate = run(api, threads, n)
+        if base is None:
+            base = rate
+        print('%2d threads %8.0f requests/s %5.1fx' % (threads, rate, rate / base))
+    api.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,7 @@ import sys
 import datetime
 import logging
 import tempfile
-from urlparse import urlparse
+from urllib.parse import urlparse
 from pprint import pprint
 import json
 
@@ -34,6 +34,7 @@ class Spider:
         self.api = api
         self.start_url = start_url
         self.outdir = outdir
+        self.downloads = []
 
     def run(self):
         todo_urls = set([self.start_url])
@@ -44,6 +45,15 @@ class Spider:
             self.spider_one(seen_urls, todo_urls, media_todo_urls)
         while media_todo_urls:
             self.spider_media(media_seen_urls, media_todo_urls)
+        self.download_files()
+
+    def download_files(self):
+        manager = van_api.DownloadManager(self.api, workers=8, per_host=4)
+        results = manager.download(self.downloads,
+                progress=lambda stats: logging.info('Downloaded %s' % stats))
+        for result in results:
+            if result.error is not None:
+                logging.error('Could not download %s: %s' % (result.url, result.error))
 
     def get_outfile(self, url):
         url = urlparse(url)
@@ -109,7 +119,9 @@ class Spider:
         if resp is not None:
             # look for urls in the response
             if 'download_url' in resp:
-                go_urls.add(resp['download_url'])
+                # expects a file download url like: /{iid}/files/{uuid}/download/...
+                outfile = self.get_outfile(resp['download_url'].split('/download')[0])
+                self.downloads.append((resp['download_url'], '%s.data' % outfile, resp.get('size')))
             if 'items' in resp:
                 if 'next' in resp:
                     next_url = '%s?%s' % (url.split('?')[0], resp['next'])
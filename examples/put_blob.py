@@ -19,23 +19,20 @@ api = van_api.API('api.metropublisher.com', credentials)
 file_upload_uuid = uuid.uuid1()
 here = os.path.dirname(__file__)
 flag = os.path.join(here, 'littlevanguardistasflag.jpg')
-flag_file = open(flag, 'rb')
-try:
+with open(flag, 'rb') as flag_file:
     flag_contents = flag_file.read()
-except:
-    flag_file.close()
 
-print 'Putting metadata'
+print('Putting metadata')
 result = api.PUT('/%s/files/%s' % (iid, file_upload_uuid),
         {"title": "A Flag",
             "filename": "littlevanguardistasflag.jpg",
             "created": "2000-01-01T10:30:58",
             "modified": "2000-01-01T10:30:58"})
 pprint(result)
-print 'Putting binary data'
+print('Putting binary data')
 result = api.POST('/%s/files/%s' % (iid, file_upload_uuid),
         flag_contents, content_type="image/jpeg")
 pprint(result)
-print 'Getting metadata'
+print('Getting metadata')
 result = api.GET('/%s/files/%s' % (iid, file_upload_uuid))
 pprint(result)
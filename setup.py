@@ -1,5 +1,4 @@
 import os
-import sys
 from setuptools import setup, find_packages
 
 _here = os.path.dirname(__file__)
@@ -10,11 +9,6 @@ f.close()
 
 install_requires = []
 
-if sys.version_info[:2] == (2, 5):
-    install_requires.append('simplejson')
-if sys.version_info[:2] == (2, 4):
-    install_requires.append('simplejson < 1.9999')
-
 tests_require = [
         'mock'
         ]
@@ -37,16 +31,13 @@ setup(name="van_api",
           "Intended Audience :: Developers",
           "Operating System :: OS Independent",
           "License :: OSI Approved :: BSD License",
-          "Programming Language :: Python :: 2",
-          "Programming Language :: Python :: 2.6",
-          "Programming Language :: Python :: 2.7",
           "Programming Language :: Python :: 3",
-          "Programming Language :: Python :: 3.2",
-          "Programming Language :: Python :: 3.3",
-          "Programming Language :: Python :: 3.4",
+          "Programming Language :: Python :: 3 :: Only",
           ],
+      python_requires='>=3.7',
       extras_require = {
           'testing':testing_extra,
+          'parquet':['pyarrow'],
           },
       test_suite='tests',
       tests_require=tests_require,
@@ -7,45 +7,81 @@ Vanguardistas APIs. It provides the functionality:
     * Convert API errors into python exceptions
     * Retrieving/renewing access tokens as required
     * Re-trying requests if possible on various errors
+    * Bounding requests by connect/read timeouts and an overall deadline
+    * Paging through collections and exporting them to CSV, JSON Lines or Parquet
+    * Caching lookups in memory and, optionally, across runs
+    * Handling responses in a pool of processes
+    * Recording and replaying HTTP traffic for offline testing
+    * Synchronizing collections incrementally
+    * Storing downloaded files deduplicated by content
+    * Adapting the number of concurrent requests to the server
+    * Scheduling requests by priority
+    * Reusing TLS sessions when reconnecting
+    * Caching DNS lookups and racing connections to all addresses of a host
+    * Connecting through Unix domain sockets or HTTP proxies
+    * Queueing and coalescing writes to send them in batches
+    * Profiling API usage by URL template
+    * Downloading many files concurrently, with resume and a bandwidth cap
+    * Tracing requests with spans and traceparent headers
+    * Warming up connections and access tokens before the first request
+    * Building collection queries with projection and tuned page sizes
+    * Passing responses through undecoded, optionally streaming them
+    * Sharing one API between threads
+    * Serving stale responses while the API is slow or unreachable
 """
 
 import sys
-import logging
-from pprint import pformat
-
-try:
-    from json import loads as _json_loads
-    from json import dumps as _json_dumps
-except ImportError:
-    # python 2.5
-    from simplejson import dumps as _json_dumps
-    from simplejson import loads as _sj_json_loads
-    def _json_loads(data):
-        return _sj_json_loads(unicode(data))
-
-_PY3 = sys.version_info[0] == 3
-
-if _PY3:
-    from urllib.parse import urlencode
-    import http.client as httplib
-    import urllib.parse as urlparse
-else:
-    from urllib import urlencode
-    import httplib
-    import urlparse
-
-if _PY3:
-    _unicode = str
-else:
-    _unicode = unicode
-
-if _PY3:
-    def _reraise(exc_info):
-        raise exc_info[1].with_traceback(exc_info[2])
-else:
-    exec("""def _reraise(exc_info):
-    raise exc_info[0], exc_info[1], exc_info[2]
-""")
+import time
+import random
+import functools
+import threading
+from collections import namedtuple, deque
+
+# Modules which are slow to import (json, logging, pprint, http.client and
+# ssl, ...) are imported when they are first used, so that importing van_api
+# stays cheap for short-lived processes. tests.py checks this.
+
+def _json_loads(data):
+    import json
+    return json.loads(data)
+
+def _json_dumps(data, **kw):
+    import json
+    return json.dumps(data, **kw)
+
+def _reraise(exc_info):
+    raise exc_info[1].with_traceback(exc_info[2])
+
+def _default_logger():
+    import logging
+    return logging
+
+def _default_conn_factory():
+    import http.client
+    return http.client.HTTPSConnection
+
+def _default_ssl_context():
+    import ssl
+    return ssl.create_default_context()
+
+class _LazyDefault(object):
+    """A default for an instance attribute, computed on first access.
+
+    The computed value is stored on the instance, so later accesses cost
+    nothing extra. Threads racing on the first access all get the value
+    stored first.
+    """
+
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        return obj.__dict__.setdefault(self.name, self.factory())
+
+_DEFAULT = object()
 
 
 class APIError(Exception):
@@ -65,14 +101,30 @@ class APIError(Exception):
         self.url = url
         msg = error
         if description:
+            from pprint import pformat
             msg = '%s: %s\n%s' % (msg, description, pformat(info))
         Exception.__init__(self, msg)
 
+class DeadlineExceeded(Exception):
+    """The deadline for an operation passed before it could complete"""
+
 class Retryable(Exception):
-    """Represents a caught, but retryable error"""
+    """Represents a caught, but retryable error
+
+    maybe_applied is True if the request reached the server before the error,
+    so that it may have been applied. Such requests are only retried if they
+    are idempotent.
+
+    If backoff is True the server is overloaded, and the retry waits
+    retry_after seconds, or an exponentially growing delay if that is None.
+    """
 
-    def __init__(self, msg, exc_info=None):
+    def __init__(self, msg, exc_info=None, maybe_applied=False, backoff=False,
+            retry_after=None):
         self.exc_info = exc_info
+        self.maybe_applied = maybe_applied
+        self.backoff = backoff
+        self.retry_after = retry_after
         Exception.__init__(self, msg)
 
     def reraise(self):
@@ -80,17 +132,148 @@ class Retryable(Exception):
             _reraise(self.exc_info)
         raise
 
-def _httplib_response_to_dict(request, resp):
+class Deadline(object):
+    """A point in time by which an operation must be complete.
+
+    A single deadline is shared by everything done on behalf of one call:
+    getting an access token, every retry and reading the response body.
+    """
+
+    def __init__(self, timeout, clock=time.time):
+        self.clock = clock
+        self.expires = clock() + timeout
+
+    def remaining(self):
+        """Seconds left before the deadline, negative if it has passed"""
+        return self.expires - self.clock()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, timeout=None):
+        """Return timeout, reduced to the time remaining before the deadline.
+
+        Raises DeadlineExceeded if the deadline has already passed.
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded('Deadline exceeded')
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+def _as_deadline(deadline):
+    """Convert a timeout in seconds to a Deadline, passing through others"""
+    if deadline is None or isinstance(deadline, Deadline):
+        return deadline
+    return Deadline(deadline)
+
+# Methods which have the same effect if repeated (RFC 7231 4.2.2)
+_IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'])
+
+# Raised when sending on, or reading the status line from, a kept-alive
+# connection the server has closed meanwhile (includes
+# http.client.RemoteDisconnected).
+_STALE_CONNECTION_ERRORS = (ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+
+def _has_idempotency_key(headers):
+    if not headers:
+        return False
+    for name in headers:
+        if name.lower() == 'idempotency-key':
+            return True
+    return False
+
+# Delay before the first retry of an overloaded server, doubled for every
+# further attempt up to _MAX_BACKOFF. Longer Retry-After values are not
+# waited for.
+_BACKOFF = 0.5
+_MAX_BACKOFF = 8.0
+_MAX_RETRY_AFTER = 60.0
+
+def _retry_after(value, clock=time.time):
+    """Seconds to wait according to a Retry-After header value, or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_tz, mktime_tz
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - clock())
+
+def _set_timeouts(conn, connect_timeout, read_timeout):
+    """Set the timeout for the next connect or socket operation of conn"""
+    sock = getattr(conn, 'sock', None)
+    if sock is None:
+        # http.client uses conn.timeout when it (re-)connects
+        conn.timeout = connect_timeout
+    else:
+        sock.settimeout(read_timeout)
+
+def _read_body(resp, deadline=None):
+    if deadline is None:
+        return resp.read()
+    chunks = []
+    data = resp.read(8192)
+    while data:
+        deadline.timeout()
+        chunks.append(data)
+        data = resp.read(8192)
+    return b''.join(chunks)
+
+class _Headers(list):
+    """A list of (name, value) header pairs with case-insensitive lookup.
+
+    Lookups are remembered, so each header name is only searched for once.
+    The list must not be modified after the first lookup.
+    """
+
+    _found = None
+
+    def get(self, name, default=None):
+        name = name.lower()
+        found = self._found
+        if found is None:
+            found = self._found = {}
+        elif name in found:
+            value = found[name]
+            return default if value is None else value
+        value = None
+        for k, v in self:
+            if k.lower() == name:
+                value = v
+                break
+        found[name] = value
+        return default if value is None else value
+
+def _getheaders(resp):
+    headers = resp.getheaders()
+    if isinstance(headers, list):
+        headers = _Headers(headers)
+    return headers
+
+def _httplib_response_to_dict(request, resp, deadline=None):
     return dict(
             status=resp.status,
-            headers=resp.getheaders(),
-            body=resp.read(),
+            headers=_getheaders(resp),
+            body=_read_body(resp, deadline),
             reason=resp.reason)
 
-def write_body_to_file(response, outfile):
-    """Write a httplib response to an open file.
+def _default_http_handler(deadline=None):
+    if deadline is None:
+        return _httplib_response_to_dict
+    return functools.partial(_httplib_response_to_dict, deadline=deadline)
+
+def write_body_to_file(response, outfile, deadline=None):
+    """Write an http.client response to an open file.
 
-    This will replace all data in outfile with the http response data.
+    This will replace all data in outfile with the http response data. If a
+    deadline is given, DeadlineExceeded is raised if it passes while data is
+    still being read.
     """
     # make sure the outfile is empty by seek/truncate
     # we can be retried and don't want to rewrite
@@ -99,122 +282,1497 @@ def write_body_to_file(response, outfile):
     outfile.truncate(0)
     data = response.read(8192)
     while data:
+        if deadline is not None:
+            deadline.timeout()
         outfile.write(data)
         data = response.read(8192)
 
+class ResponseStream(object):
+    """The body of a response, read on demand.
+
+    Read it with read() or by iterating over it, and close it when done.
+    The connection goes back to the pool if the body was read completely,
+    otherwise it is closed.
+    """
+
+    _release = None
+
+    def __init__(self, resp):
+        self._resp = resp
+
+    def read(self, amt=None):
+        return self._resp.read(amt)
+
+    def readinto(self, b):
+        return self._resp.readinto(b)
+
+    def __iter__(self):
+        while True:
+            data = self._resp.read(65536)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        resp, self._resp = self._resp, None
+        if resp is None:
+            return
+        complete = resp.isclosed()
+        resp.close()
+        if self._release is not None:
+            self._release(complete)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _stream_response(request, resp):
+    """http_handler returning the body of successful responses as a
+    ResponseStream (in response['stream'])"""
+    response = dict(status=resp.status, headers=_getheaders(resp), body=None, reason=resp.reason)
+    if resp.status in (200, 201, 206):
+        response['stream'] = ResponseStream(resp)
+    else:
+        response['body'] = resp.read()
+    return response
+
 class _WriteToFile:
 
-    def __init__(self, outfile):
+    def __init__(self, outfile, deadline=None):
         self.outfile = outfile
+        self.deadline = deadline
 
     def __call__(self, request, resp):
         d = dict(
                 status=resp.status,
-                headers=resp.getheaders(),
+                headers=_getheaders(resp),
                 body=None,
                 reason=resp.reason)
-        write_body_to_file(resp, self.outfile)
+        write_body_to_file(resp, self.outfile, self.deadline)
         return d
 
+def _debug_enabled(logger):
+    """Is debug logging enabled, so it is worth formatting debug messages?"""
+    import logging
+    if logger is logging:
+        logger = logging.getLogger()
+    return logger.isEnabledFor(logging.DEBUG)
+
+_record_types = {}
+
+def _record_type(fields):
+    """Return a tuple backed record class with the given field names"""
+    fields = tuple(fields)
+    cls = _record_types.get(fields)
+    if cls is None:
+        cls = _record_types[fields] = namedtuple('Record', fields, rename=True)
+    return cls
+
+def _query_fields(url):
+    """Return the field names of a fields=a-b-c query parameter, or None"""
+    from urllib.parse import urlsplit, parse_qs
+    fields = parse_qs(urlsplit(url).query).get('fields')
+    if not fields:
+        return None
+    return fields[0].split('-')
+
+def _scan_json_items(text, meta):
+    """Decode the JSON object text, yielding the elements of its items array.
+
+    The items are decoded one at a time, so only the ones the caller keeps
+    stay in memory. The other keys are decoded into the dict meta, where
+    items is only marked as present (None).
+    """
+    import json
+    from json.decoder import WHITESPACE
+    ws = WHITESPACE.match
+    scan_once = json.JSONDecoder().scan_once
+    def scan(end):
+        try:
+            return scan_once(text, end)
+        except StopIteration:
+            raise ValueError('Expecting value at %s' % end)
+    def expect(end, chars):
+        end = ws(text, end).end()
+        c = text[end:end + 1]
+        if c not in chars or not c:
+            raise ValueError('Expecting %r at %s' % (chars, end))
+        return c, ws(text, end + 1).end()
+    c, end = expect(0, '{')
+    if text[end:end + 1] == '}':
+        return
+    while True:
+        key, end = scan(end)
+        c, end = expect(end, ':')
+        if key == 'items' and text[end:end + 1] == '[':
+            meta[key] = None
+            end = ws(text, end + 1).end()
+            if text[end:end + 1] == ']':
+                end += 1
+            else:
+                while True:
+                    item, end = scan(end)
+                    yield item
+                    c, end = expect(end, ',]')
+                    if c == ']':
+                        break
+        else:
+            meta[key], end = scan(end)
+        c, end = expect(end, ',}')
+        if c == '}':
+            return
+
+class Page(object):
+    """A lazily decoded response body, usually a page of a collection.
+
+    Like the dict returned by API.GET it supports page['items'],
+    page.get('next') and 'next' in page. page['items'] decodes the whole
+    body, afterwards only the decoded data is kept.
+
+    iter_items(), records() and columns() decode the JSON body one item at a
+    time and don't keep the items, nor does looking up the other keys. That
+    saves memory, not time: decoding item by item in Python takes two to
+    four times as long as page['items'], so use them for pages which would
+    not comfortably fit in memory decoded. Item lists (returned by the API
+    for fields=-restricted listings) are turned into tuple backed records
+    named by the requested fields.
+    """
+
+    __slots__ = ('_body', '_content_type', '_deserialize', '_data', '_meta', 'fields')
+
+    def __init__(self, body, content_type=None, fields=None, deserialize=None):
+        self._body = body
+        self._content_type = content_type
+        self._deserialize = deserialize
+        self._data = None
+        self._meta = None
+        self.fields = fields
+
+    @property
+    def data(self):
+        """The decoded body"""
+        if self._body is not None:
+            self._data = self._deserialize(self._body, self._content_type)
+            self._body = self._meta = None
+        return self._data
+
+    def _lookup(self, key):
+        """Return a dict holding key, without decoding the items if possible"""
+        if key == 'items' or self._body is None:
+            return self.data
+        if self._meta is None:
+            for item in self.iter_items():
+                pass
+        return self._meta
+
+    def __getitem__(self, key):
+        return self._lookup(key)[key]
+
+    def __contains__(self, key):
+        if self._body is not None:
+            return key in self._lookup(None)
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self._lookup(key).get(key, default)
+
+    def keys(self):
+        return self.data.keys()
+
+    def _text(self):
+        body = self._body
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        return body
+
+    def iter_items(self):
+        """Iterate over the decoded items of the page.
+
+        Unless the page was decoded already, the items are decoded one at a
+        time and not kept.
+        """
+        if self._body is None:
+            data = self.data
+            if data:
+                for item in data.get('items', ()):
+                    yield item
+            return
+        meta = {}
+        for item in _scan_json_items(self._text(), meta):
+            yield item
+        self._meta = meta
+
+    def records(self):
+        """Iterate over the items of the page as records.
+
+        Records are built one at a time while decoding. Items which cannot
+        be named are returned as plain tuples.
+        """
+        fields = self.fields
+        named = None
+        if fields is not None:
+            named = (fields, _record_type(fields))
+        # record type by the keys of dict items, in order
+        types = {}
+        for item in self.iter_items():
+            if isinstance(item, dict):
+                keys, cls = named or types.get(tuple(item), (None, None))
+                if cls is None:
+                    keys = sorted(item)
+                    keys, cls = types[tuple(item)] = (keys, _record_type(keys))
+                yield cls._make([item.get(k) for k in keys])
+            elif named is not None and len(fields) == len(item):
+                yield named[1]._make(item)
+            else:
+                yield tuple(item)
+
+    def columns(self):
+        """Return the items of the page as a dict of field name to list of values.
+
+        Only possible if the fields of the items are known, i.e. they were
+        requested with fields= or the items are dicts.
+        """
+        fields = self.fields
+        columns = None
+        for item in self.iter_items():
+            if columns is None:
+                named = isinstance(item, dict)
+                if named:
+                    fields = fields or sorted(item)
+                elif fields is None:
+                    raise ValueError('Cannot name columns without fields=')
+                columns = [[] for f in fields]
+            if named:
+                for column, field in zip(columns, fields):
+                    column.append(item.get(field))
+            else:
+                for column, value in zip(columns, item):
+                    column.append(value)
+        if columns is None:
+            return dict((f, []) for f in fields or ())
+        return dict(zip(fields, columns))
+
+
+def _check_field(name):
+    if not name or '-' in name or not all(c.isalnum() or c in '_.' for c in name):
+        raise ValueError('Invalid field name: %r' % (name,))
+    return name
+
+class Query(str):
+    """The url of a collection with its projection (fields), page size (rpp)
+    and other query parameters.
+
+    A Query is the url string, so it can be used wherever a url is:
+
+        query = api.query('/1/locations', fields=['url', 'title'], rpp=100)
+        for item in api.iter_items(query.filter(modified_after='2020-01-01')):
+            ...
+
+    Queries are immutable, with_fields, with_rpp and filter return new ones.
+    If rpp is not given, API.iter_pages picks the page size, see RPPTuner.
+    """
+
+    def __new__(cls, path, fields=None, rpp=None, params=()):
+        from urllib.parse import urlencode
+        if '?' in path:
+            raise ValueError('Pass query parameters as params, not in the path: %s' % path)
+        if fields is not None:
+            fields = tuple(_check_field(f) for f in fields)
+            if not fields:
+                raise ValueError('fields must not be empty')
+        if rpp is not None:
+            if isinstance(rpp, bool) or not isinstance(rpp, int) or rpp < 1:
+                raise ValueError('rpp must be a positive integer: %r' % (rpp,))
+        params = tuple(params)
+        for name, value in params:
+            if name in ('fields', 'rpp'):
+                raise ValueError('Use fields= and rpp= instead of params for %s' % name)
+        query = []
+        if fields is not None:
+            query.append(('fields', '-'.join(fields)))
+        if rpp is not None:
+            query.append(('rpp', rpp))
+        query.extend(params)
+        url = path
+        if query:
+            url = '%s?%s' % (path, urlencode(query))
+        self = str.__new__(cls, url)
+        self.path = path
+        self.fields = fields
+        self.rpp = rpp
+        self.params = params
+        return self
+
+    def __getnewargs__(self):
+        return self.path, self.fields, self.rpp, self.params
+
+    @classmethod
+    def parse(cls, url):
+        """Return url as a Query"""
+        if isinstance(url, cls):
+            return url
+        from urllib.parse import parse_qsl
+        path, _, query = url.partition('?')
+        fields = rpp = None
+        params = []
+        for name, value in parse_qsl(query, keep_blank_values=True):
+            if name == 'fields':
+                fields = value.split('-')
+            elif name == 'rpp':
+                rpp = int(value)
+            else:
+                params.append((name, value))
+        return cls(path, fields, rpp, params)
+
+    def with_fields(self, fields):
+        return self.__class__(self.path, fields, self.rpp, self.params)
+
+    def with_rpp(self, rpp):
+        return self.__class__(self.path, self.fields, rpp, self.params)
+
+    def filter(self, **params):
+        """Add query parameters"""
+        return self.__class__(self.path, self.fields, self.rpp,
+                self.params + tuple(sorted(params.items())))
+
+class RPPTuner(object):
+    """Choose the page size (rpp) fetching most items per second.
+
+    The time to fetch full pages is recorded by URL template and page size.
+    Once a page size was measured on samples pages, twice and half that size
+    are tried as well, within min_rpp and max_rpp. Then the fastest one is
+    used. The page size can't change while paging through a collection, so
+    this takes effect over several iterations.
+    """
+
+    def __init__(self, initial=100, min_rpp=10, max_rpp=1000, samples=3):
+        self.initial = initial
+        self.min_rpp = min_rpp
+        self.max_rpp = max_rpp
+        self.samples = samples
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def suggest(self, template):
+        """Return the page size to use for the collection at template"""
+        with self._lock:
+            stats = self._stats.get(template)
+            if not stats:
+                return self.initial
+            measured = {}
+            for rpp, (pages, seconds) in stats.items():
+                if pages < self.samples:
+                    return rpp
+                measured[rpp] = pages * rpp / seconds if seconds > 0 else float('inf')
+            best = max(measured, key=measured.get)
+            for candidate in (best * 2, best // 2):
+                if self.min_rpp <= candidate <= self.max_rpp and candidate not in stats:
+                    return candidate
+            return best
+
+    def record(self, template, rpp, seconds):
+        """Record that a full page of rpp items took seconds to fetch"""
+        with self._lock:
+            stats = self._stats.setdefault(template, {})
+            pages, total = stats.get(rpp, (0, 0.0))
+            stats[rpp] = (pages + 1, total + seconds)
+
+
+class ConcurrencyLimiter(object):
+    """Limit the number of requests in flight, adapting the limit to the server.
+
+    The limit grows by about one for every limit requests completed at close
+    to the lowest latency seen (additive increase). When the latency grows
+    beyond tolerance times that, the limit shrinks slowly; it is multiplied
+    by backoff when the server is overloaded, i.e. answers 429 or 503 or the
+    connection fails (multiplicative decrease). So concurrency converges to
+    what the server can sustain.
+
+    Threaded callers use acquire()/release() or pass the limiter to API:
+
+        api = API(host, credentials, limiter=ConcurrencyLimiter())
+
+    Callers running an event loop, which must not block, use try_acquire()
+    and retry later if it returns False.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, backoff=0.5, tolerance=2.0,
+            clock=time.time):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.clock = clock
+        self.in_flight = 0
+        self.min_latency = None
+        self.completed = 0
+        self.overloaded = 0
+        self._last_decrease = None
+        self._cond = threading.Condition()
+
+    def try_acquire(self):
+        """Take a slot if one is free, return whether it was taken"""
+        with self._cond:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self, timeout=None):
+        """Wait for a free slot, return False if none was free within timeout"""
+        end = None
+        if timeout is not None:
+            end = self.clock() + timeout
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                if end is None:
+                    self._cond.wait()
+                else:
+                    remaining = end - self.clock()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, overloaded=False):
+        """Give back a slot, reporting the latency of the request and if the
+        server was overloaded."""
+        with self._cond:
+            self.in_flight -= 1
+            self.completed += 1
+            if overloaded:
+                self.overloaded += 1
+                now = self.clock()
+                # many requests fail at once on overload, only back off once
+                # per round trip
+                if self._last_decrease is None or now - self._last_decrease > (self.min_latency or 0):
+                    self._last_decrease = now
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+            else:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if latency > self.min_latency * self.tolerance:
+                    self.limit = max(self.min_limit, self.limit - 1 / self.limit)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+@functools.lru_cache(maxsize=4096)
+def _url_template(url):
+    """Return the path of url with ids replaced by placeholders.
+
+    The first numeric segment is the instance id ({iid}), other numeric
+    segments become {id} and UUIDs {uuid}:
+
+        /123/files/0f4c...?fields=url -> /{iid}/files/{uuid}
+    """
+    import re
+    path = url.split('?', 1)[0]
+    if '://' in path:
+        path = '/' + path.split('://', 1)[1].partition('/')[2]
+    segments = []
+    for segment in path.split('/'):
+        if segment.isdigit():
+            segment = '{id}' if '{iid}' in segments else '{iid}'
+        elif re.match(r'^[0-9a-fA-F]{8}-?([0-9a-fA-F]{4}-?){3}[0-9a-fA-F]{12}$', segment):
+            segment = '{uuid}'
+        segments.append(segment)
+    return '/'.join(segments)
+
+class _ProfileEntry(object):
+
+    __slots__ = ('calls', 'errors', 'retries', 'bytes_out', 'bytes_in', 'time')
+
+    def __init__(self):
+        self.calls = self.errors = self.retries = self.bytes_out = self.bytes_in = 0
+        self.time = 0.0
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+class Profiler(object):
+    """Account API requests by method and URL template.
+
+    For every template and method it counts calls, failed calls, retries,
+    bytes sent and received and the time spent, including retries. Pass it
+    to API to enable it:
+
+        profiler = Profiler()
+        api = API(host, credentials, profiler=profiler)
+        profiler.dump_at_exit()
+
+    report() formats the numbers as a table, as_dict() for JSON.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def record(self, method, url, elapsed, attempts=1, error=False, bytes_out=0, bytes_in=0):
+        key = (method, _url_template(url))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _ProfileEntry()
+            entry.calls += 1
+            entry.retries += attempts - 1
+            if error:
+                entry.errors += 1
+            entry.bytes_out += bytes_out
+            entry.bytes_in += bytes_in
+            entry.time += elapsed
+
+    def reset(self):
+        with self._lock:
+            self._entries = {}
+
+    def as_dict(self):
+        """Return {"METHOD template": {"calls": ..., ...}}"""
+        with self._lock:
+            return dict(('%s %s' % key, entry.as_dict()) for key, entry in self._entries.items())
+
+    def report(self):
+        """Return a table of the numbers, most time consuming first"""
+        with self._lock:
+            entries = sorted(self._entries.items(), key=lambda i: -i[1].time)
+            lines = ['%-7s %-40s %7s %6s %7s %10s %10s %9s %8s' % ('method', 'template', 'calls',
+                'errors', 'retries', 'bytes out', 'bytes in', 'time (s)', 'avg (ms)')]
+            for (method, template), e in entries:
+                lines.append('%-7s %-40s %7d %6d %7d %10d %10d %9.3f %8.1f' % (method, template,
+                    e.calls, e.errors, e.retries, e.bytes_out, e.bytes_in, e.time,
+                    e.time / e.calls * 1000))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, outfile=None, format='table'):
+        """Write the report (format='table') or JSON (format='json') to
+        outfile, by default stderr."""
+        if outfile is None:
+            outfile = sys.stderr
+        if format == 'json':
+            outfile.write(_json_dumps(self.as_dict(), sort_keys=True, indent=2) + '\n')
+        else:
+            outfile.write(self.report())
+        outfile.flush()
+
+    def dump_at_exit(self, outfile=None, format='table'):
+        """dump() when the process exits"""
+        import atexit
+        atexit.register(self.dump, outfile, format)
+
+    def dump_on_signal(self, signum, outfile=None, format='table'):
+        """dump() whenever the process receives signal signum, e.g.
+        signal.SIGUSR1. Must be called from the main thread."""
+        import signal
+        signal.signal(signum, lambda signum, frame: self.dump(outfile, format))
+
+def _profile_handler(handler, received):
+    def profile_handler(request, response):
+        body = response.get('body')
+        if body is not None:
+            received[0] += len(body)
+        else:
+            headers = response.get('headers')
+            if not isinstance(headers, _Headers):
+                headers = _Headers(headers or [])
+            received[0] += int(headers.get('Content-Length', 0))
+        if handler is None:
+            return response
+        return handler(request, response)
+    return profile_handler
+
+
+_trace_context = threading.local()
+
+def _current_span():
+    return getattr(_trace_context, 'span', None)
+
+def _child_span(name, attributes=None):
+    """Return a new child of the current span, or None if nothing is traced"""
+    parent = _current_span()
+    if parent is None:
+        return None
+    return parent.tracer.span(name, attributes=attributes)
+
+def _parse_traceparent(value):
+    """Return (trace_id, parent_id) of a W3C traceparent header, or None"""
+    parts = value.strip().split('-')
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2]
+
+class Span(object):
+    """A timed operation in a trace.
+
+    Spans are context managers; while one is entered, it is the parent of
+    spans started in the same thread. On exit it is passed to the exporter
+    of its Tracer.
+    """
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes=None):
+        import os
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.status = 'UNSET'
+        self.start = tracer.clock()
+        self.end = None
+        self._previous = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def traceparent(self):
+        """Return the W3C traceparent header value for this span"""
+        return '00-%s-%s-01' % (self.trace_id, self.span_id)
+
+    def __enter__(self):
+        self._previous = _current_span()
+        _trace_context.span = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _trace_context.span = self._previous
+        self._previous = None
+        if value is not None:
+            self.status = 'ERROR'
+            self.attributes['exception.type'] = type.__name__
+            self.attributes['exception.message'] = str(value)
+        self.end = self.tracer.clock()
+        self.tracer.exporter.export([self])
+        return False
+
+    def as_dict(self):
+        """Return the span in the field names of OTLP/JSON"""
+        return dict(
+                traceId=self.trace_id,
+                spanId=self.span_id,
+                parentSpanId=self.parent_id or '',
+                name=self.name,
+                startTimeUnixNano=self.start,
+                endTimeUnixNano=self.end,
+                attributes=self.attributes,
+                status=dict(code=self.status))
+
+class Tracer(object):
+    """Create spans around API requests and export them.
+
+        tracer = Tracer(JSONFileExporter('spans.jsonl'))
+        api = API(host, credentials, tracer=tracer)
+
+    API.request, fetching access tokens, each HTTP attempt and opening
+    connections get a span. Requests carry a traceparent header, so the
+    server's spans join the trace. To continue a trace started elsewhere,
+    call API methods within tracer.span(name, parent=traceparent).
+
+    An exporter is any object with an export(spans) method.
+    """
+
+    def __init__(self, exporter, clock=time.time_ns):
+        self.exporter = exporter
+        self.clock = clock
+
+    def span(self, name, parent=None, attributes=None):
+        """Start a span. parent is a Span or a traceparent header value and
+        defaults to the current span of this thread."""
+        import os
+        if parent is None:
+            parent = _current_span()
+        if isinstance(parent, Span):
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        else:
+            trace_id, parent_id = _parse_traceparent(parent or '') or (None, None)
+        if trace_id is None:
+            trace_id = os.urandom(16).hex()
+        return Span(self, name, trace_id, parent_id, attributes)
+
+class JSONFileExporter(object):
+    """Append spans to a file as JSON lines, see Span.as_dict"""
+
+    def __init__(self, path):
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(_json_dumps(span.as_dict(), sort_keys=True) + '\n' for span in spans)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+def _timed_handler(span, handler, attribute):
+    """Wrap a handler to record on span how long it took (in ms)"""
+    def timed_handler(request, response):
+        started = span.tracer.clock()
+        try:
+            return handler(request, response)
+        finally:
+            span.set_attribute(attribute, (span.tracer.clock() - started) / 1e6)
+    return timed_handler
+
+def _traced_http_handler(span, http_handler):
+    """Wrap a http_handler to record the time to first byte, the time spent
+    reading the body and the status on span."""
+    def traced_http_handler(request, resp):
+        started = span.tracer.clock()
+        span.set_attribute('van_api.ttfb_ms', (started - span.start) / 1e6)
+        span.set_attribute('http.status_code', resp.status)
+        try:
+            return http_handler(request, resp)
+        finally:
+            span.set_attribute('van_api.body_read_ms', (span.tracer.clock() - started) / 1e6)
+    return traced_http_handler
+
+
+class TLSSessionCache(object):
+    """One SSLContext shared by all connections, and the TLS sessions they
+    negotiated.
+
+    Building an SSLContext loads the trusted certificates, so it is done
+    once. When reconnecting to a host the last session is offered to the
+    server, which lets it skip the full handshake and certificate exchange.
+
+    API uses one by default, pass tls=TLSSessionCache(context) to use a
+    custom context or to share sessions between several API objects. Sessions
+    cannot be shared across processes.
+    """
+
+    context = _LazyDefault('context', _default_ssl_context)
+
+    def __init__(self, context=None, clock=time.perf_counter):
+        if context is not None:
+            self.context = context
+        self.clock = clock
+        self.handshakes = 0
+        self.resumed = 0
+        self.handshake_time = 0.0
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def wrap_socket(self, sock, server_hostname, port):
+        """Do the TLS handshake on sock, resuming a session if possible"""
+        key = (server_hostname, port)
+        session = self._sessions.get(key)
+        started = self.clock()
+        sock = self.context.wrap_socket(sock, server_hostname=server_hostname, session=session)
+        elapsed = self.clock() - started
+        with self._lock:
+            self.handshakes += 1
+            self.handshake_time += elapsed
+            if sock.session_reused:
+                self.resumed += 1
+        self.save(sock, server_hostname, port)
+        return sock
+
+    def save(self, sock, server_hostname, port):
+        """Remember the session of sock for the next connection.
+
+        With TLS 1.3 the session ticket is only sent after the handshake, so
+        this is done again once a response was read.
+        """
+        session = getattr(sock, 'session', None)
+        if session is not None:
+            self._sessions[(server_hostname, port)] = session
+
+    def clear(self):
+        """Forget all sessions, so the next connections do a full handshake"""
+        self._sessions.clear()
+
+    def stats(self):
+        """Return a dict with the number of handshakes, how many of them
+        resumed a session and the total time spent in them (seconds)."""
+        with self._lock:
+            return dict(
+                    handshakes=self.handshakes,
+                    resumed=self.resumed,
+                    handshake_time=self.handshake_time)
+
+def _interleave_families(infos):
+    """Order getaddrinfo results alternating address families, keeping the
+    resolver's preference within each family (RFC 8305)."""
+    by_family = []
+    for info in infos:
+        for group in by_family:
+            if group[0][0] == info[0]:
+                group.append(info)
+                break
+        else:
+            by_family.append([info])
+    ordered = []
+    while by_family:
+        for group in list(by_family):
+            ordered.append(group.pop(0))
+            if not group:
+                by_family.remove(group)
+    return ordered
+
+def _race_connect(infos, timeout, delay, source_address=None, clock=time.monotonic):
+    """Connect to the first of infos which answers ("happy eyeballs").
+
+    A connection attempt is started every delay seconds, or as soon as the
+    previous one failed, without cancelling those still in progress. The
+    first socket to connect is returned, the others are closed.
+    """
+    import errno
+    import socket
+    import selectors
+    end = None if timeout is None else clock() + timeout
+    pending = list(infos)
+    selector = selectors.DefaultSelector()
+    error = None
+    winner = None
+    next_start = clock()
+    try:
+        while pending or selector.get_map():
+            now = clock()
+            if end is not None and now >= end:
+                raise socket.timeout('timed out')
+            if pending and now >= next_start:
+                family, type, proto, _, address = pending.pop(0)
+                sock = socket.socket(family, type, proto)
+                sock.setblocking(False)
+                try:
+                    if source_address:
+                        sock.bind(source_address)
+                    err = sock.connect_ex(address)
+                except OSError as e:
+                    err = e.errno
+                if err == 0:
+                    winner = sock
+                    break
+                if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    sock.close()
+                    error = OSError(err, 'Connect to %s failed' % (address,))
+                    continue
+                selector.register(sock, selectors.EVENT_WRITE, address)
+                next_start = now + delay
+            wait = None
+            if pending:
+                wait = max(0, next_start - now)
+            if end is not None:
+                wait = max(0, end - now) if wait is None else min(wait, max(0, end - now))
+            for key, _ in selector.select(wait):
+                sock = key.fileobj
+                selector.unregister(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    winner = sock
+                    break
+                sock.close()
+                error = OSError(err, 'Connect to %s failed' % (key.data,))
+                next_start = clock()
+            if winner is not None:
+                break
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+    if winner is None:
+        if error is None:
+            error = OSError('getaddrinfo returned an empty list')
+        raise error
+    winner.settimeout(timeout)
+    return winner
+
+class DNSCache(object):
+    """Resolve host names at most once every ttl seconds, and connect by
+    racing the addresses found.
+
+    getaddrinfo does not tell how long its answer is valid, so a fixed ttl
+    is used. The address which connected is tried first next time; an entry
+    is dropped when no address could be connected to.
+    """
+
+    def __init__(self, ttl=60, delay=0.25, resolver=None, clock=time.monotonic):
+        self.ttl = ttl
+        self.delay = delay
+        self.resolver = resolver
+        self.clock = clock
+        self.lookups = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """Return the getaddrinfo results for host and port, possibly cached"""
+        key = (host, port)
+        entry = self._entries.get(key)
+        now = self.clock()
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        resolver = self.resolver
+        import socket
+        if resolver is None:
+            resolver = socket.getaddrinfo
+        infos = _interleave_families(resolver(host, port, 0, socket.SOCK_STREAM))
+        with self._lock:
+            self.lookups += 1
+            self._entries[key] = (now + self.ttl, infos)
+        return infos
+
+    def create_connection(self, address, timeout=None, source_address=None):
+        """Drop in replacement for socket.create_connection"""
+        import socket
+        host, port = address
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        infos = self.resolve(host, port)
+        try:
+            sock = _race_connect(infos, timeout, self.delay, source_address, self.clock)
+        except socket.timeout:
+            raise
+        except OSError:
+            self.forget(host, port)
+            raise
+        peer = sock.getpeername()
+        if infos[0][4][:2] != peer[:2]:
+            self._prefer(host, port, peer)
+        return sock
+
+    def _prefer(self, host, port, peer):
+        with self._lock:
+            entry = self._entries.get((host, port))
+            if entry is None:
+                return
+            expires, infos = entry
+            first = [i for i in infos if i[4][:2] == peer[:2]]
+            rest = [i for i in infos if i[4][:2] != peer[:2]]
+            self._entries[(host, port)] = (expires, first + rest)
+
+    def forget(self, host, port):
+        """Drop the cached addresses of host and port"""
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_TLSConnection = None
+
+def _tls_connection_class():
+    """Return a HTTPSConnection subclass doing its handshake through a
+    TLSSessionCache."""
+    global _TLSConnection
+    if _TLSConnection is not None:
+        return _TLSConnection
+    import http.client
+
+    class _TLSConnectionClass(http.client.HTTPSConnection):
+
+        def __init__(self, host, tls, dns=None, **kw):
+            http.client.HTTPSConnection.__init__(self, host, context=tls.context, **kw)
+            self.tls = tls
+            if dns is not None:
+                self._create_connection = dns.create_connection
+
+        def _tls_peer(self):
+            if self._tunnel_host:
+                return self._tunnel_host, self._tunnel_port
+            return self.host, self.port
+
+        def connect(self):
+            span = _child_span('van_api.connect', {'server.address': self.host})
+            if span is None:
+                return self._connect()
+            with span:
+                self._connect()
+                span.set_attribute('tls.resumed', self.sock.session_reused)
+
+        def _connect(self):
+            http.client.HTTPConnection.connect(self)
+            server_hostname, port = self._tls_peer()
+            self.sock = self.tls.wrap_socket(self.sock, server_hostname, port)
+
+        def getresponse(self):
+            resp = http.client.HTTPSConnection.getresponse(self)
+            if self.sock is not None:
+                self.tls.save(self.sock, *self._tls_peer())
+            return resp
+
+        def close(self):
+            if self.sock is not None:
+                self.tls.save(self.sock, *self._tls_peer())
+            http.client.HTTPSConnection.close(self)
+
+    _TLSConnection = _TLSConnectionClass
+    return _TLSConnection
+
+_UnixConnection = None
+
+def _unix_connection_class():
+    """Return a HTTPConnection subclass connecting to a Unix domain socket"""
+    global _UnixConnection
+    if _UnixConnection is not None:
+        return _UnixConnection
+    import socket
+    import http.client
+
+    class _UnixConnectionClass(http.client.HTTPConnection):
+
+        def __init__(self, host, path, **kw):
+            http.client.HTTPConnection.__init__(self, host, **kw)
+            self.path = path
+
+        def connect(self):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except:
+                sock.close()
+                raise
+            self.sock = sock
+
+    _UnixConnection = _UnixConnectionClass
+    return _UnixConnection
+
+class UnixSocketTransport(object):
+    """A conn_factory sending requests over a Unix domain socket.
+
+    This is meant for a sidecar proxy on the same host which forwards
+    requests to the API, so requests are plain HTTP and the proxy does TLS:
+
+        api = API('api.metropublisher.com', credentials,
+                conn_factory=UnixSocketTransport('/run/sidecar.sock'))
+
+    The Host header is still the API host.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, host):
+        return _unix_connection_class()(host, self.path)
+
+class ProxyTransport(object):
+    """A conn_factory tunnelling HTTPS connections through an HTTP proxy.
+
+    Every new connection sends a CONNECT request to proxy (host:port) and
+    then does TLS with the API host through it. headers are sent with the
+    CONNECT request, e.g. Proxy-Authorization. Like direct connections, the
+    tunnels are pooled and reuse tls and dns.
+
+        api = API('api.metropublisher.com', credentials,
+                conn_factory=ProxyTransport('localhost:3128'))
+    """
+
+    tls = _LazyDefault('tls', TLSSessionCache)
+    dns = _LazyDefault('dns', DNSCache)
+
+    def __init__(self, proxy, headers=None, tls=None, dns=None):
+        self.proxy = proxy
+        self.headers = headers
+        if tls is not None:
+            self.tls = tls
+        if dns is not None:
+            self.dns = dns
+
+    def __call__(self, host):
+        conn = _tls_connection_class()(self.proxy, self.tls, self.dns)
+        conn.set_tunnel(host, headers=self.headers)
+        return conn
+
+
 class _HTTPConnection(object):
-    """Mixing class deailing with a single HTTP/HTTPS connection.
+    """Mixing class deailing with HTTP/HTTPS connections to a single host.
 
     Handles connect/disconnect, requests and retries for the connection.
+
+    Connections are kept in a pool so that requests from several threads
+    do not interleave on one socket. At most pool_size idle connections are
+    kept open.
+
+    connect_timeout and read_timeout are in seconds, None means wait forever.
+
+    If a ConcurrencyLimiter is given, every request waits for a slot from it.
+    If a Profiler is given, every request and its retries are accounted in it.
+    If a Tracer is given, every request gets a span.
+
+    HTTPS connections share the SSLContext and resume the TLS sessions of
+    tls, a TLSSessionCache. They look up the host through dns, a DNSCache.
+    Neither is used with a custom conn_factory.
     """
 
-    _conn = None
-    _conn_factory = None
+    logger = _LazyDefault('logger', _default_logger)
+    _conn_factory = _LazyDefault('_conn_factory', _default_conn_factory)
+    profiler = tracer = None
+    _sleep = staticmethod(time.sleep)
+    tls = _LazyDefault('tls', TLSSessionCache)
+    dns = _LazyDefault('dns', DNSCache)
 
-    def __init__(self, host, conn_factory=httplib.HTTPSConnection, logger=logging):
+    def __init__(self, host, conn_factory=None, logger=_DEFAULT,
+            connect_timeout=None, read_timeout=None, pool_size=10, limiter=None, tls=None,
+            dns=None, profiler=None, tracer=None):
         self.host = host
-        self.logger = logger
-        self._conn_factory = conn_factory
+        if logger is not _DEFAULT:
+            self.logger = logger
+        if conn_factory is not None:
+            self._conn_factory = conn_factory
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.limiter = limiter
+        if tls is not None:
+            self.tls = tls
+        if dns is not None:
+            self.dns = dns
+        self.profiler = profiler
+        self.tracer = tracer
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _get_idle_conn(self):
+        if self._idle:
+            return self._idle[-1]
+        return None
 
-    def http(self, method, url, body=None, headers=None, handler=None, http_handler=None):
+    def _set_idle_conn(self, conn):
+        with self._lock:
+            self._idle[:] = [] if conn is None else [conn]
+
+    # The connection the next request will use, if one is open
+    _conn = property(_get_idle_conn, _set_idle_conn)
+
+    def http(self, method, url, body=None, headers=None, handler=None, http_handler=None,
+            connect_timeout=None, read_timeout=None, deadline=None):
         """Send a single HTTP request to the API.
 
         This is a low level method. It fails on all errors.
+
+        The timeouts override the ones of the connection for this request.
+        They are reduced to the time remaining if a deadline is given.
         """
+        attributes = {'http.method': method, 'http.url': url, 'server.address': self.host}
+        if self.tracer is not None:
+            span = self.tracer.span('van_api.http', attributes=attributes)
+        else:
+            span = _child_span('van_api.http', attributes)
+        if span is None:
+            return self._http(method, url, body, headers, handler, http_handler,
+                    connect_timeout, read_timeout, deadline)
+        with span:
+            headers = dict(headers or {})
+            headers['traceparent'] = span.traceparent()
+            if http_handler is None:
+                http_handler = _default_http_handler(deadline)
+            http_handler = _traced_http_handler(span, http_handler)
+            if handler is not None:
+                handler = _timed_handler(span, handler, 'van_api.deserialize_ms')
+            return self._http(method, url, body, headers, handler, http_handler,
+                    connect_timeout, read_timeout, deadline)
+
+    def _http(self, method, url, body, headers, handler, http_handler,
+            connect_timeout, read_timeout, deadline):
+        if connect_timeout is None:
+            connect_timeout = self.connect_timeout
+        if read_timeout is None:
+            read_timeout = self.read_timeout
+        if deadline is not None:
+            connect_timeout = deadline.timeout(connect_timeout)
+            read_timeout = deadline.timeout(read_timeout)
+        timeouts = connect_timeout is not None or read_timeout is not None
         url = self._get_path(url)
-        conn = self._get_conn()
         request = dict(method=method, host=self.host, url=url, body=body, headers=headers)
         if http_handler is None:
-            http_handler = _httplib_response_to_dict
-        if self.logger is not None:
+            http_handler = _default_http_handler(deadline)
+        debug = self.logger is not None and _debug_enabled(self.logger)
+        if debug:
+            from pprint import pformat
             self.logger.debug('REQUEST:\n%s', pformat(request))
+        limiter = self.limiter
+        if limiter is not None:
+            self._acquire_slot(limiter, deadline)
+            started = time.time()
+            overloaded = True
         try:
-            conn.request(method, url, body=body, headers=headers)
-            resp = conn.getresponse()
-            response = http_handler(request, resp)
-        except:
-            self._disconnect()
-            if self.logger is not None:
-                self.logger.info("HTTP Connection Error", exc_info=True)
-            raise Retryable('HTTP Connection Error', exc_info=sys.exc_info())
-        if self.logger is not None:
+            conn = self._get_idle_conn_or_none()
+            reused = conn is not None
+            if conn is None:
+                conn = self._new_conn()
+            while True:
+                sent = False
+                resp = None
+                try:
+                    if timeouts:
+                        _set_timeouts(conn, connect_timeout, read_timeout)
+                    conn.request(method, url, body=body, headers=headers)
+                    sent = True
+                    if timeouts:
+                        _set_timeouts(conn, connect_timeout, read_timeout)
+                    resp = conn.getresponse()
+                    response = http_handler(request, resp)
+                    break
+                except:
+                    self._disconnect(conn)
+                    exc = sys.exc_info()[1]
+                    if self.logger is not None:
+                        self.logger.info("HTTP Connection Error", exc_info=True)
+                    if (reused and resp is None and isinstance(exc, _STALE_CONNECTION_ERRORS)
+                            and (not sent or method in _IDEMPOTENT_METHODS
+                                or _has_idempotency_key(headers))):
+                        # The server most likely closed the idle connection
+                        # before reading the request. Unless sending failed,
+                        # that's not certain, so only safe requests are
+                        # sent again.
+                        if hasattr(body, 'read'):
+                            # let http_retry rewind the body
+                            raise Retryable('Stale connection', exc_info=sys.exc_info())
+                        reused = False
+                        conn = self._new_conn()
+                        continue
+                    raise Retryable('HTTP Connection Error', exc_info=sys.exc_info(),
+                            maybe_applied=sent)
+            if limiter is not None:
+                overloaded = isinstance(response, dict) and response.get('status') in (429, 503)
+        finally:
+            if limiter is not None:
+                limiter.release(time.time() - started, overloaded)
+        stream = response.get('stream') if isinstance(response, dict) else None
+        if stream is None:
+            self._put_conn(conn)
+        else:
+            # the connection is busy until the body was read
+            stream._release = functools.partial(self._release_conn, conn)
+        if debug:
+            from pprint import pformat
             self.logger.debug('RESPONSE:\n%s', pformat(response))
         if handler is not None:
-            response = handler(request, response)
+            try:
+                response = handler(request, response)
+            except:
+                if stream is not None:
+                    stream.close()
+                raise
         return response
 
+    def _acquire_slot(self, limiter, deadline):
+        if deadline is None:
+            limiter.acquire()
+        elif not limiter.acquire(deadline.timeout()):
+            raise DeadlineExceeded('Deadline exceeded waiting for a concurrency slot')
+
     def _get_path(self, url):
-        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        from urllib.parse import urlsplit, urlunsplit
+        scheme, netloc, path, query, fragment = urlsplit(url)
         if netloc and self.host != netloc:
             raise AssertionError("Cannot connect to url: %s" % url)
-        if scheme and self._conn_factory is httplib.HTTPSConnection and scheme != 'https':
+        if scheme and scheme != 'https' and self._conn_factory is _default_conn_factory():
             raise AssertionError("Strange scheme: %s" % url)
-        return urlparse.urlunsplit(('', '', path, query, ''))
+        return urlunsplit(('', '', path, query, ''))
 
     def _get_conn(self):
-        if self._conn is not None:
-            return self._conn
-        self._conn = self._conn_factory(self.host)
-        return self._get_conn()
+        conn = self._get_idle_conn_or_none()
+        if conn is None:
+            conn = self._new_conn()
+        return conn
+
+    def _get_idle_conn_or_none(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return None
+
+    def _new_conn(self):
+        conn_factory = self._conn_factory
+        if conn_factory is _default_conn_factory():
+            return _tls_connection_class()(self.host, self.tls, self.dns)
+        return conn_factory(self.host)
+
+    def _put_conn(self, conn):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
 
     def http_retry(self, *args, **kw):
-        """Run an http query, retrying on retriable errors"""
+        """Run an http query, retrying on retriable errors
+
+        Retrying stops with DeadlineExceeded if a deadline is passed in and
+        expires.
+
+        A request which may have reached the server is only retried if its
+        method is idempotent, it has an Idempotency-Key header or
+        idempotent=True is passed. File bodies are rewound before retrying,
+        if they can't be the error is raised.
+
+        If on_retry is passed, it is called with the keyword arguments before
+        every retry and may change them, e.g. the headers.
+
+        When the server is overloaded (429 or 503), retries wait as long as
+        its Retry-After header asks, or back off exponentially without one.
+        """
+        idempotent = kw.pop('idempotent', False)
+        on_retry = kw.pop('on_retry', None)
+        profiler = self.profiler
+        if profiler is not None:
+            return self._profile_retry(profiler, args, kw, idempotent, on_retry)
+        return self._http_retry(args, kw, idempotent=idempotent, on_retry=on_retry)
+
+    def _profile_retry(self, profiler, args, kw, idempotent=False, on_retry=None):
+        method = args[0] if args else kw.get('method')
+        url = args[1] if len(args) > 1 else kw.get('url')
+        body = kw.get('body')
+        bytes_out = len(body) if isinstance(body, (bytes, str)) else 0
+        received = [0]
+        kw['handler'] = _profile_handler(kw.get('handler'), received)
+        attempts = [0]
+        error = True
+        started = profiler.clock()
+        try:
+            result = self._http_retry(args, kw, attempts, idempotent, on_retry)
+            error = False
+            return result
+        finally:
+            profiler.record(method, url, profiler.clock() - started, attempts[0], error,
+                    bytes_out, received[0])
+
+    def _http_retry(self, args, kw, attempts=None, idempotent=False, on_retry=None):
+        deadline = kw.get('deadline')
+        method = args[0] if args else kw.get('method')
+        body = kw.get('body')
+        position = None
+        if hasattr(body, 'read'):
+            try:
+                position = body.tell()
+            except (AttributeError, OSError):
+                pass
         attempt = 1
         while True:
+            if attempts is not None:
+                attempts[0] = attempt
             try:
                 return self.http(*args, **kw)
             except Retryable:
+                exc = sys.exc_info()[1]
+                if exc.maybe_applied and not (idempotent or method in _IDEMPOTENT_METHODS
+                        or _has_idempotency_key(kw.get('headers'))):
+                    if self.logger is not None:
+                        self.logger.warn('Not retrying %s, it may have been applied', method,
+                                exc_info=True)
+                    exc.reraise()
                 if self.logger is not None:
                     self.logger.warn('Attempt %s failed',
                             attempt,
                             exc_info=True)
+                if hasattr(body, 'read'):
+                    if position is None:
+                        exc.reraise()
+                    body.seek(position)
+                if deadline is not None and deadline.expired():
+                    raise DeadlineExceeded('Deadline exceeded after %s attempts' % attempt)
                 if attempt >= 5:
                     exc = sys.exc_info()[1]
                     exc.reraise()
                     raise AssertionError("Bad retryable exception: %s" % exc)
+                if exc.backoff:
+                    self._backoff(exc, attempt, deadline)
+            if on_retry is not None:
+                on_retry(kw)
             attempt += 1
 
-    def _disconnect(self):
-        conn = self._conn
-        self._conn = None
-        if conn is not None:
-            conn.close()
+    def _backoff(self, exc, attempt, deadline):
+        delay = exc.retry_after
+        if delay is None:
+            delay = min(_BACKOFF * 2 ** (attempt - 1), _MAX_BACKOFF)
+            delay *= random.uniform(0.5, 1.0)
+        elif delay > _MAX_RETRY_AFTER:
+            exc.reraise()
+        if deadline is not None and delay >= deadline.remaining():
+            raise DeadlineExceeded('Deadline exceeded after %s attempts' % attempt)
+        self._sleep(delay)
 
+    def _release_conn(self, conn, reusable):
+        if reusable:
+            self._put_conn(conn)
+        else:
+            self._disconnect(conn)
 
-class Credentials(object):
-    """Abstract class representing credentials to access the API"""
+    def _open_conn(self):
+        conn = self._new_conn()
+        connect = getattr(conn, 'connect', None)
+        if connect is not None:
+            if self.connect_timeout is not None:
+                conn.timeout = self.connect_timeout
+            try:
+                connect()
+            except:
+                conn.close()
+                raise
+        return conn
+
+    def warmup(self, connections=2):
+        """Open connections until connections (at most pool_size) are idle.
+
+        The connections are opened concurrently. Returns how many were opened.
+        """
+        with self._lock:
+            missing = min(connections, self.pool_size) - len(self._idle)
+        if missing <= 0:
+            return 0
+        opened = 0
+        for conn in _imap(lambda i: self._open_conn(), range(missing), missing):
+            self._put_conn(conn)
+            opened += 1
+        return opened
+
+    def _disconnect(self, conn):
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class Credentials(object):
+    """Abstract class representing credentials to access the API"""
 
     def __init__(self, host='go.vanguardistas.net', **kw):
         self.conn = _HTTPConnection(host, **kw)
 
-    def access_token(self, api):
+    def access_token(self, api, deadline=None):
         """This method is called to get the access token.
 
-        It must raise an error if an access token is not available.
+        It must raise an error if an access token is not available. If a
+        Deadline is passed, the token must be retrieved before it expires.
         """
         raise NotImplementedError
 
-    def _token(self, api, data):
+    def _token(self, api, data, deadline=None, idempotent=False):
+        """POST data to the token endpoint.
+
+        Pass idempotent=True if the grant may be repeated, so that the POST
+        is retried even if it may have reached the server.
+        """
+        from urllib.parse import urlencode
         data = urlencode(data)
         headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        kw = {}
+        if deadline is not None:
+            kw['deadline'] = deadline
+        if idempotent:
+            kw['idempotent'] = True
         return self.conn.http_retry('POST', '/oauth/token',
                 body=data,
                 headers=headers,
-                handler=api.handle)
+                handler=api.handle,
+                **kw)
 
 
 class ClientCredentialsGrant(Credentials):
@@ -224,70 +1782,326 @@ class ClientCredentialsGrant(Credentials):
         self.api_key = api_key
         self.api_secret = api_secret
 
-    def access_token(self, api):
+    def access_token(self, api, deadline=None):
         data = {'grant_type': 'client_credentials',
                 'api_key': self.api_key,
                 'api_secret': self.api_secret}
-        return self._token(api, data)
+        # getting another token with the same credentials does no harm
+        if deadline is None:
+            return self._token(api, data, idempotent=True)
+        return self._token(api, data, deadline=deadline, idempotent=True)
+
+
+_STATUS_HANDLER_PREFIX = '_handle_status_'
+_status_handlers = {}
+
+def _get_status_handlers(cls):
+    """Return a dict of HTTP status to _handle_status_XXX method of cls"""
+    handlers = _status_handlers.get(cls)
+    if handlers is None:
+        handlers = {}
+        for name in dir(cls):
+            if not name.startswith(_STATUS_HANDLER_PREFIX):
+                continue
+            try:
+                status = int(name[len(_STATUS_HANDLER_PREFIX):])
+            except ValueError:
+                continue
+            handlers[status] = getattr(cls, name)
+        _status_handlers[cls] = handlers
+    return handlers
+
 
+def _conn_attribute(name):
+    """An API attribute which is the one of its connection, api.conn"""
+    return property(lambda self: getattr(self.conn, name),
+            lambda self, value: setattr(self.conn, name, value))
 
 class API(_HTTPConnection):
-    """A proxy object for the MP api."""
+    """A proxy object for the MP api.
+
+    connect_timeout and read_timeout (in seconds) bound every socket
+    operation, deadline (in seconds) bounds every call as a whole. All of them
+    can be overridden per call.
+
+    The headers sent with every request are built once and cached until the
+    access token changes. To change default_headers, assign a new dict rather
+    than modifying it in place.
+
+    Requests failing after they reached the server are only retried if they
+    are idempotent. If the API supports it, pass idempotency_keys=True to
+    send POST and PATCH requests with a unique Idempotency-Key header, so
+    that they can be retried too.
+
+    An API can be shared between threads. Each request checks out its own
+    connection from the pool, so at most pool_size connections are kept
+    open. Only one thread fetches a new access token while the others wait
+    for it; reading the token and the cached headers takes no lock.
+    """
 
     _access_token = None
+    _headers_cache = None
+    _write_behinds = ()
+    _read_throughs = ()
+    rpp_tuner = _LazyDefault('rpp_tuner', RPPTuner)
+    tls = _conn_attribute('tls')
+    dns = _conn_attribute('dns')
+    limiter = _conn_attribute('limiter')
+    profiler = _conn_attribute('profiler')
+    tracer = _conn_attribute('tracer')
 
-    def __init__(self, host, credentials=None, logger=logging, default_headers=None, **kw):
+    def __init__(self, host, credentials=None, logger=_DEFAULT, default_headers=None,
+            deadline=None, idempotency_keys=False, **kw):
         self.conn = _HTTPConnection(host, logger=logger, **kw)
-        self.logger = logger
+        if logger is not _DEFAULT:
+            self.logger = logger
         self._creds = credentials
         if default_headers is None:
             default_headers = {}
         self.default_headers = default_headers
+        self.deadline = deadline
+        self.idempotency_keys = idempotency_keys
+        self._lock = threading.RLock()
 
-    def GET(self, url, outfile=None):
-        """GET a resource"""
-        kw = {}
+    def GET(self, url, outfile=None, lazy=False, raw=False, stream=False, **kw):
+        """GET a resource
+
+        If lazy is True, the response is returned as a Page which is only
+        decoded when accessed.
+
+        If raw is True, the response dict (status, headers, body and reason)
+        is returned with the body undecoded, see handle_raw. With stream=True
+        as well, the body is not read: response['stream'] is a
+        ResponseStream which must be closed. The deadline does not cover
+        reading it. In both cases errors are handled and retried as usual.
+        """
+        if lazy:
+            kw['handler'] = self.handle_page
+        if raw or stream:
+            kw['handler'] = self.handle_raw
+        if stream:
+            kw['http_handler'] = _stream_response
         if outfile is not None:
-            kw['http_handler'] = _WriteToFile(outfile)
+            kw['deadline'] = deadline = self._get_deadline(kw.get('deadline'))
+            kw['http_handler'] = _WriteToFile(outfile, deadline)
         return self.request('GET', url, **kw)
 
-    def PUT(self, url, data):
+    def PUT(self, url, data, **kw):
         """PUT data to a resource"""
-        return self.request('PUT', url, data)
+        return self.request('PUT', url, data, **kw)
 
-    def DELETE(self, url):
+    def DELETE(self, url, **kw):
         """DELETE a resource"""
-        return self.request('DELETE', url)
+        return self.request('DELETE', url, **kw)
 
-    def POST(self, url, data, content_type=None):
+    def POST(self, url, data, content_type=None, **kw):
         """POST a resource"""
-        return self.request('POST', url, data, content_type=content_type)
+        return self.request('POST', url, data, content_type=content_type, **kw)
 
-    def PATCH(self, url, data):
+    def PATCH(self, url, data, **kw):
         """PATCH a resource"""
-        return self.request('PATCH', url, data)
+        return self.request('PATCH', url, data, **kw)
 
-    def request(self, method, url, data=None, content_type=None, http_handler=None, handler=None):
+    def request(self, method, url, data=None, content_type=None, http_handler=None, handler=None,
+            connect_timeout=None, read_timeout=None, deadline=None, headers=None):
         """Make an HTTP request to the API.
 
         The request will be retried on retryable errors (e.g. HTTP connection
         issues).
 
+        The response is converted by handler, by default the handle method.
+        headers are sent in addition to the default headers.
+
         If there is no access token yet the credentials will be asked for one.
         This will also occur with expired tokens. Access tokens will be cached
         for later requests.
+
+        deadline may be a number of seconds or a Deadline. It covers getting
+        the access token, all retries and reading the response. If it passes
+        DeadlineExceeded is raised.
         """
-        access_token = self._get_access_token()
-        headers = self.default_headers.copy()
-        if access_token is not None:
-            headers['Authorization'] = self._auth_header(access_token)
+        tracer = self.conn.tracer
+        if tracer is not None:
+            attributes = {'http.method': method, 'van_api.url_template': _url_template(url)}
+            with tracer.span('van_api.request', attributes=attributes):
+                return self._request(method, url, data, content_type, http_handler, handler,
+                        connect_timeout, read_timeout, deadline, headers)
+        return self._request(method, url, data, content_type, http_handler, handler,
+                connect_timeout, read_timeout, deadline, headers)
+
+    def _request(self, method, url, data, content_type, http_handler, handler,
+            connect_timeout, read_timeout, deadline, headers):
+        deadline = self._get_deadline(deadline)
+        access_token = self._get_access_token(deadline)
+        extra_headers = headers
         data, data_headers = self._serialize(data, content_type)
-        headers.update(data_headers)
-        return self.conn.http_retry(method, url, body=data, headers=headers, handler=self.handle, http_handler=http_handler)
+        if (self.idempotency_keys and method not in _IDEMPOTENT_METHODS
+                and not _has_idempotency_key(extra_headers)):
+            # the same key is sent on every retry
+            import uuid
+            data_headers['Idempotency-Key'] = uuid.uuid4().hex
+        headers = self._request_headers(access_token, data_headers, extra_headers)
+        kw = {}
+        if self._creds is not None:
+            sent_token = [access_token]
+            def on_retry(kw):
+                # a 401 dropped the token, retry with a new one
+                token = self._get_access_token(deadline)
+                if token is not sent_token[0]:
+                    sent_token[0] = token
+                    kw['headers'] = self._request_headers(token, data_headers, extra_headers)
+            kw['on_retry'] = on_retry
+        if connect_timeout is not None:
+            kw['connect_timeout'] = connect_timeout
+        if read_timeout is not None:
+            kw['read_timeout'] = read_timeout
+        if deadline is not None:
+            kw['deadline'] = deadline
+        if handler is None:
+            handler = self.handle
+        return self.conn.http_retry(method, url, body=data, headers=headers, handler=handler, http_handler=http_handler, **kw)
+
+    def query(self, url, fields=None, rpp=None, **params):
+        """Return a Query for the collection at url.
+
+        fields and rpp replace those in url, params are added to its query
+        parameters.
+        """
+        query = Query.parse(url)
+        if fields is not None:
+            query = query.with_fields(fields)
+        if rpp is not None:
+            query = query.with_rpp(rpp)
+        if params:
+            query = query.filter(**params)
+        return query
+
+    def iter_pages(self, url, **kw):
+        """Iterate over all pages of a collection, following the next links.
+
+        Keyword arguments are passed to GET, e.g. lazy=True.
+
+        If url is a Query without rpp, the page size is chosen by rpp_tuner.
+        """
+        tuner = None
+        if isinstance(url, Query) and url.rpp is None and self.rpp_tuner is not None:
+            tuner = self.rpp_tuner
+            template = _url_template(url.path)
+            url = url.with_rpp(tuner.suggest(template))
+        started = time.time()
+        result = self.GET(url, **kw)
+        while True:
+            elapsed = time.time() - started
+            yield result
+            # looked up after the caller went through a lazy Page's items,
+            # which decodes the other keys along the way
+            next_url = result.get('next')
+            if tuner is not None and next_url:
+                # only full pages tell the time per rpp items
+                tuner.record(template, url.rpp, elapsed)
+            if not next_url:
+                break
+            if '?' not in next_url:
+                next_url = '%s?%s' % (url.split('?')[0], next_url)
+            started = time.time()
+            result = self.GET(next_url, **kw)
+
+    def iter_items(self, url, **kw):
+        """Iterate over all items of a collection"""
+        for page in self.iter_pages(url, **kw):
+            items = page.iter_items() if isinstance(page, Page) else page['items']
+            for item in items:
+                yield item
+
+    def warmup(self, connections=2, background=False):
+        """Get ready for requests in a freshly started process.
+
+        Fetches the access token and opens connections (resolving the host
+        and doing the TLS handshakes) all at once, so that the first
+        requests don't pay for them one after another. Errors are logged, not
+        raised; the requests will run into them again.
+
+        Returns a dict with whether there is a token, how many connections
+        were opened and the errors. With background=True it returns at once
+        a started thread doing the warmup.
+        """
+        if background:
+            thread = threading.Thread(target=self.warmup, args=(connections,))
+            thread.daemon = True
+            thread.start()
+            return thread
+        def task(name):
+            try:
+                if name == 'token':
+                    # also builds the cached request headers
+                    self._get_headers(self._get_access_token(self._get_deadline(None)))
+                    return 0, None
+                return self.conn.warmup(connections), None
+            except Exception:
+                if self.logger is not None:
+                    self.logger.warn('Warmup %s failed', name, exc_info=True)
+                return 0, sys.exc_info()[1]
+        results = list(_imap(task, ['token', 'connections'], 2))
+        return dict(
+                token=self._access_token is not None,
+                connections=results[1][0],
+                errors=[error for opened, error in results if error is not None])
+
+    def write_behind(self, **kw):
+        """Return a WriteBehind queue for this API, see WriteBehind for the
+        arguments. close() sends the writes remaining in it."""
+        writes = WriteBehind(self, **kw)
+        with self._lock:
+            self._write_behinds = self._write_behinds + (writes,)
+        return writes
+
+    def read_through(self, **kw):
+        """Return a ReadThroughCache for this API, see ReadThroughCache for
+        the arguments. close() stops its background refreshes."""
+        cache = ReadThroughCache(self, **kw)
+        with self._lock:
+            self._read_throughs = self._read_throughs + (cache,)
+        return cache
+
+    def close(self):
+        """Send queued writes and close all open connections"""
+        for cache in self._read_throughs:
+            cache.close()
+        for writes in self._write_behinds:
+            writes.close()
+        self.conn.close()
+
+    def _get_deadline(self, deadline):
+        if deadline is None:
+            deadline = self.deadline
+        return _as_deadline(deadline)
 
     def handle(self, request, response):
-        handler = getattr(self, '_handle_status_%s' % response['status'], self._handle_error)
-        return handler(request, response)
+        handler = _get_status_handlers(self.__class__).get(response['status'])
+        if handler is None:
+            return self._handle_error(request, response)
+        return handler(self, request, response)
+
+    def handle_page(self, request, response):
+        """Like handle, but return successful responses as a lazy Page"""
+        if response['status'] in (200, 201) and response['body']:
+            content_type = self._get_header('Content-Type', response['headers'])
+            return Page(response['body'],
+                    content_type,
+                    _query_fields(request['url']),
+                    self._deserialize)
+        return self.handle(request, response)
+
+    def handle_raw(self, request, response):
+        """Like handle, but return successful responses without decoding them.
+
+        The response dict (status, headers, body and reason) is returned. 206
+        (Partial Content) responses to Range requests and 304 (Not Modified)
+        responses to conditional requests count as successful.
+        """
+        if response['status'] in (200, 201, 206, 304):
+            return response
+        return self.handle(request, response)
 
     def _handle_error(self, request, response):
         data = {'error': response['status']}
@@ -303,10 +2117,22 @@ class API(_HTTPConnection):
                 data.get('error_url'))
 
     def _handle_status_503(self, request, response):
-        raise Retryable("Service temporarily unavailable")
+        raise Retryable("Service temporarily unavailable", backoff=True,
+                retry_after=_retry_after(self._get_header('Retry-After', response['headers'])))
+
+    def _handle_status_429(self, request, response):
+        raise Retryable("Too many requests", backoff=True,
+                retry_after=_retry_after(self._get_header('Retry-After', response['headers'])))
 
     def _handle_status_401(self, request, response):
-        self._access_token = None
+        used = None
+        if isinstance(request, dict) and request.get('headers'):
+            used = request['headers'].get('Authorization')
+        with self._lock:
+            token = self._access_token
+            # another thread may have fetched a new token already
+            if used is None or token is None or used == self._auth_header(token):
+                self._access_token = None
         raise Retryable("Expired token?") # XXX - have the 401 method decide if the token was expired or not
 
     def _handle_status_200(self, request, response):
@@ -318,13 +2144,57 @@ class API(_HTTPConnection):
 
     _handle_status_201 = _handle_status_200
 
-    def _get_access_token(self):
-        if self._access_token is not None:
+    def _get_access_token(self, deadline=None):
+        token = self._access_token
+        if token is not None or self._creds is None:
+            return token
+        if deadline is None:
+            self._lock.acquire()
+        elif not self._lock.acquire(timeout=deadline.timeout()):
+            raise DeadlineExceeded('Deadline exceeded waiting for the access token')
+        try:
+            # fetched by another thread while waiting for the lock?
+            token = self._access_token
+            if token is not None:
+                return token
+            tracer = self.conn.tracer
+            if tracer is None:
+                self._fetch_access_token(deadline)
+            else:
+                with tracer.span('van_api.access_token'):
+                    self._fetch_access_token(deadline)
             return self._access_token
-        if self._creds is None:
-            return None
-        self._access_token = self._creds.access_token(self)
-        return self._get_access_token()
+        finally:
+            self._lock.release()
+
+    def _fetch_access_token(self, deadline):
+        if deadline is None:
+            self._access_token = self._creds.access_token(self)
+        else:
+            self._access_token = self._creds.access_token(self, deadline=deadline)
+
+    def _request_headers(self, access_token, data_headers, extra_headers):
+        headers = self._get_headers(access_token)
+        if data_headers or extra_headers:
+            headers = headers.copy()
+            headers.update(data_headers)
+            if extra_headers:
+                headers.update(extra_headers)
+        return headers
+
+    def _get_headers(self, access_token):
+        """Return the default and Authorization headers.
+
+        The returned dict is shared between requests and must not be modified.
+        """
+        cached = self._headers_cache
+        if cached is not None and cached[0] is access_token and cached[1] is self.default_headers:
+            return cached[2]
+        headers = self.default_headers.copy()
+        if access_token is not None:
+            headers['Authorization'] = self._auth_header(access_token)
+        self._headers_cache = (access_token, self.default_headers, headers)
+        return headers
 
     def _auth_header(self, token):
         assert token['token_type'] == 'bearer'
@@ -339,12 +2209,1803 @@ class API(_HTTPConnection):
         return data, {'Content-Type': content_type}
 
     def _get_header(self, header, headers):
-        header = header.lower()
-        for k, v in headers:
-            if k.lower() == header:
-                return v
+        if not isinstance(headers, _Headers):
+            headers = _Headers(headers)
+        return headers.get(header)
 
     def _deserialize(self, data, content_type):
-        if _PY3:
-            data = data.decode('ascii')
-        return _json_loads(data)
+        return _deserialize(data, content_type)
+
+def _deserialize(data, content_type):
+    return _json_loads(data.decode('ascii'))
+
+
+def _imap(func, iterable, workers):
+    """Like map(), but call func in worker threads.
+
+    Results are yielded in the order of iterable. At most 2 * workers items
+    are in progress at any time, so memory stays bounded for long iterables.
+    """
+    import queue
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+    todo = queue.Queue(workers)
+    pending = deque()
+    def work():
+        while True:
+            job = todo.get()
+            if job is None:
+                return
+            item, result = job
+            try:
+                result.put((True, func(item)))
+            except Exception:
+                result.put((False, sys.exc_info()))
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for item in iterable:
+            result = queue.Queue(1)
+            todo.put((item, result))
+            pending.append(result)
+            while len(pending) > workers * 2:
+                yield _unpack_result(pending.popleft().get())
+        while pending:
+            yield _unpack_result(pending.popleft().get())
+    finally:
+        for thread in threads:
+            todo.put(None)
+
+def _unpack_result(result):
+    ok, value = result
+    if not ok:
+        _reraise(value)
+    return value
+
+
+class ExportStats(object):
+    """Progress of an export"""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started = clock()
+        self.items = 0
+
+    @property
+    def elapsed(self):
+        return self.clock() - self.started
+
+    @property
+    def rate(self):
+        """Items exported per second"""
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.0
+        return self.items / elapsed
+
+    def __str__(self):
+        return '%s items in %.1fs (%.1f items/s)' % (self.items, self.elapsed, self.rate)
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return '|'.join([str(v) for v in value])
+    if isinstance(value, dict):
+        return _json_dumps(value)
+    return value
+
+class _CSVWriter(object):
+
+    def __init__(self, outfile, fields):
+        import csv
+        self.fields = fields
+        self.writer = csv.writer(outfile)
+        self.writer.writerow(fields)
+
+    def write(self, row):
+        self.writer.writerow([_csv_value(row.get(f)) for f in self.fields])
+
+    def close(self):
+        pass
+
+class _JSONLinesWriter(object):
+
+    def __init__(self, outfile, fields):
+        self.outfile = outfile
+        self.fields = fields
+
+    def write(self, row):
+        row = dict((f, row.get(f)) for f in self.fields)
+        self.outfile.write(_json_dumps(row, sort_keys=True))
+        self.outfile.write('\n')
+
+    def close(self):
+        pass
+
+def _parquet_kind(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, (list, tuple)):
+        return 'list'
+    # strings, and objects as JSON text
+    return 'str'
+
+def _widen_kind(kind, other):
+    """Return the kind of column holding values of both kinds"""
+    if kind is None or kind == other:
+        return other
+    if other is None:
+        return kind
+    if set([kind, other]) == set(['int', 'float']):
+        return 'float'
+    return 'str'
+
+def _parquet_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return _json_dumps(value, sort_keys=True)
+
+class _ParquetWriter(object):
+    """Write rows to a Parquet file in row groups, needs pyarrow.
+
+    Unless given in types, the type of each column is chosen from its
+    values: bool, int, float, string or list of strings. Objects and
+    columns of mixed types are written as (JSON) text, ints mixed with
+    floats as floats. Rows are buffered until all columns have a value (or
+    max_buffered rows are), so that types aren't chosen from None alone.
+    Values written later which don't fit their column's type raise
+    ValueError.
+    """
+
+    row_group_size = 10000
+    max_buffered = 100000
+
+    def __init__(self, outfile, fields, types=None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('pyarrow is required to export to parquet')
+        self.pyarrow = pyarrow
+        self.outfile = outfile
+        self.fields = fields
+        self.types = types or {}
+        for f, kind in self.types.items():
+            if kind not in ('bool', 'int', 'float', 'str', 'list'):
+                raise ValueError('Unknown parquet type %r for %s' % (kind, f))
+        self.kinds = dict((f, None) for f in fields)
+        self.columns = dict((f, []) for f in fields)
+        self.buffered = 0
+        self.writer = None
+
+    def write(self, row):
+        for f in self.fields:
+            self.columns[f].append(row.get(f))
+        self.buffered += 1
+        if self.buffered % self.row_group_size == 0:
+            self._flush()
+
+    def _flush(self, final=False):
+        if not self.buffered:
+            return
+        if self.writer is None:
+            for f in self.fields:
+                kind = self.types.get(f)
+                if kind is None:
+                    for value in self.columns[f]:
+                        if value is not None:
+                            kind = _widen_kind(kind, _parquet_kind(value))
+                self.kinds[f] = kind
+            if None in self.kinds.values() and not final and self.buffered < self.max_buffered:
+                return
+            self._open()
+        table = self.pyarrow.Table.from_pydict(
+                dict((f, self._convert(f, self.columns[f])) for f in self.fields),
+                schema=self.writer.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        self.columns = dict((f, []) for f in self.fields)
+        self.buffered = 0
+
+    def _open(self):
+        pa = self.pyarrow
+        types = {
+                'bool': pa.bool_(),
+                'int': pa.int64(),
+                'float': pa.float64(),
+                'str': pa.string(),
+                'list': pa.list_(pa.string())}
+        for f in self.fields:
+            if self.kinds[f] is None:
+                self.kinds[f] = 'str'
+        schema = pa.schema([(f, types[self.kinds[f]]) for f in self.fields])
+        self.writer = pa.parquet.ParquetWriter(self.outfile, schema)
+
+    def _convert(self, field, values):
+        kind = self.kinds[field]
+        if kind == 'str':
+            return [_parquet_text(v) for v in values]
+        if kind == 'list':
+            converted = []
+            for v in values:
+                if v is not None:
+                    if _parquet_kind(v) != 'list':
+                        self._mismatch(field, v)
+                    v = [_parquet_text(i) for i in v]
+                converted.append(v)
+            return converted
+        converted = []
+        for v in values:
+            if v is not None:
+                value_kind = _parquet_kind(v)
+                if _widen_kind(kind, value_kind) != kind:
+                    if not (kind == 'int' and value_kind == 'float' and v.is_integer()):
+                        self._mismatch(field, v)
+                    v = int(v)
+                elif kind == 'float':
+                    v = float(v)
+            converted.append(v)
+        return converted
+
+    def _mismatch(self, field, value):
+        raise ValueError('Cannot write %r to the %s column %s' % (value, self.kinds[field], field))
+
+    def close(self):
+        self._flush(final=True)
+        if self.writer is not None:
+            self.writer.close()
+
+_EXPORT_WRITERS = {
+        'csv': _CSVWriter,
+        'jsonl': _JSONLinesWriter,
+        'parquet': _ParquetWriter}
+
+def _item_url(item):
+    if isinstance(item, dict):
+        return item['url']
+    # un-named items from the API start with their url
+    return item[0]
+
+def _item_dict(item, fields):
+    """Return item, a dict or a list of values of fields, as a dict"""
+    if isinstance(item, dict):
+        return item
+    if fields is not None and len(fields) == len(item):
+        return dict(zip(fields, item))
+    raise ValueError('Cannot export un-named items, use fields= or expand=True')
+
+def export(api, url, outfile, format='csv', fields=None, expand=False, transform=None,
+        workers=4, progress=None, progress_every=1000, types=None):
+    """Export all items of the collection at url to outfile.
+
+    format is 'csv', 'jsonl' (JSON Lines) or 'parquet' (needs pyarrow, outfile
+    must be a binary file or a path). The columns are fields or, if not given,
+    the sorted keys of the first item.
+
+    Parquet column types are chosen from the values. To fix them instead,
+    pass types, a dict of field name to 'bool', 'int', 'float', 'str' or
+    'list' (of strings).
+
+    If expand is True the full item is retrieved for every item in the
+    collection, using workers concurrent requests. transform, if given, is
+    called with every item dict (in a worker thread) and returns the dict to
+    export.
+
+    Items are streamed from the collection pages to outfile, so memory use
+    does not depend on the size of the collection. progress is called with an
+    ExportStats every progress_every items. Returns the final ExportStats.
+
+    Unless url selects fields itself, only the fields exported (or, with
+    expand, only the item urls) are listed.
+    """
+    writer_factory = _EXPORT_WRITERS[format]
+    writer_kw = {}
+    if types is not None:
+        if format != 'parquet':
+            raise ValueError('types are only supported for parquet')
+        writer_kw['types'] = types
+    query = Query.parse(url)
+    if query.fields is None:
+        if expand:
+            query = query.with_fields(['url'])
+        elif fields:
+            query = query.with_fields(fields)
+    def process(item):
+        item, names = item
+        if expand:
+            item = api.GET(_item_url(item))
+        else:
+            item = _item_dict(item, names)
+        if transform is not None:
+            item = transform(item)
+        return item
+    def items():
+        for page in api.iter_pages(query, lazy=True):
+            for item in page.iter_items():
+                yield item, page.fields
+    stats = ExportStats()
+    writer = None
+    for row in _imap(process, items(), workers):
+        if writer is None:
+            if fields is None:
+                fields = sorted(row)
+            writer = writer_factory(outfile, fields, **writer_kw)
+        writer.write(row)
+        stats.items += 1
+        if progress is not None and stats.items % progress_every == 0:
+            progress(stats)
+    if writer is not None:
+        writer.close()
+    if api.logger is not None:
+        api.logger.info('Exported %s', stats)
+    return stats
+
+
+_MISSING = object()
+
+class SQLiteStore(object):
+    """Persistent storage for a Cache in an sqlite database.
+
+    Values must be serializable as JSON.
+    """
+
+    def __init__(self, path, table='cache'):
+        import sqlite3
+        self.table = table
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+                'CREATE TABLE IF NOT EXISTS %s '
+                '(key TEXT PRIMARY KEY, value TEXT, expires REAL)' % table)
+        self._db.commit()
+
+    def get(self, key):
+        """Return (value, expires) for key or None"""
+        with self._lock:
+            row = self._db.execute(
+                    'SELECT value, expires FROM %s WHERE key = ?' % self.table,
+                    (key, )).fetchone()
+        if row is None:
+            return None
+        return _json_loads(row[0]), row[1]
+
+    def set(self, key, value, expires):
+        value = _json_dumps(value)
+        with self._lock:
+            self._db.execute(
+                    'INSERT OR REPLACE INTO %s (key, value, expires) VALUES (?, ?, ?)' % self.table,
+                    (key, value, expires))
+            self._db.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute('DELETE FROM %s WHERE key = ?' % self.table, (key, ))
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM %s' % self.table)
+            self._db.commit()
+
+    def expire(self, now):
+        """Delete the entries which expired by now"""
+        with self._lock:
+            self._db.execute('DELETE FROM %s WHERE expires <= ?' % self.table, (now, ))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Cache(object):
+    """A bounded in memory cache with optional expiry and persistence.
+
+    At most maxsize entries are kept in memory, the least recently used ones
+    are evicted first. Entries expire ttl seconds after they were set (never
+    if ttl is None). If a store (e.g. SQLiteStore) is given, entries are
+    written through to it and looked up there on a miss in memory, so they
+    survive across runs.
+
+    Cached values are shared, callers must not modify them.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, store=None, clock=time.time):
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.store = store
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        now = self.clock()
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self._data[key] = entry
+                self.hits += 1
+                return entry[0]
+        if self.store is not None:
+            entry = self.store.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                with self._lock:
+                    self.store_hits += 1
+                    self._put(key, entry)
+                return entry[0]
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = self.clock() + self.ttl
+        with self._lock:
+            self._put(key, (value, expires))
+        if self.store is not None:
+            self.store.set(key, value, expires)
+
+    def _put(self, key, entry):
+        self._data.pop(key, None)
+        self._data[key] = entry
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+        if self.store is not None:
+            self.store.delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def stats(self):
+        """Return a dict of hit/miss statistics"""
+        with self._lock:
+            lookups = self.hits + self.store_hits + self.misses
+            return dict(
+                    size=len(self._data),
+                    hits=self.hits,
+                    store_hits=self.store_hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    hit_ratio=(self.hits + self.store_hits) / float(lookups) if lookups else 0.0)
+
+def _memoize_key(args, kw):
+    return _json_dumps([args, sorted(kw.items())], sort_keys=True)
+
+def memoize(func, cache=None, key=None):
+    """Return a function that caches the results of func in cache.
+
+    e.g. to cache GET requests for an hour:
+
+        cached_get = memoize(api.GET, Cache(maxsize=10000, ttl=3600))
+
+    By default the cache key is the JSON serialization of the arguments, pass
+    key to compute it from the arguments yourself. Exceptions are not cached.
+    The cache is available as the cache attribute of the returned function.
+    """
+    if cache is None:
+        cache = Cache()
+    if key is None:
+        key = lambda *args, **kw: _memoize_key(args, kw)
+    def memoized(*args, **kw):
+        k = key(*args, **kw)
+        value = cache.get(k, _MISSING)
+        if value is _MISSING:
+            value = func(*args, **kw)
+            cache.set(k, value)
+        return value
+    memoized.cache = cache
+    return memoized
+
+
+class ReadThroughCache(object):
+    """Serve GETs from a cache, so that a slow or failing API does not stall
+    readers.
+
+    Responses up to fresh seconds old are returned without a request. Older
+    ones, up to fresh + stale_while_revalidate seconds, are returned at once
+    too while workers threads fetch them again in the background. If the
+    API fails (any error but an APIError, e.g. connection errors after all
+    retries or the deadline passing), responses up to fresh + stale_if_error seconds old are returned instead
+    of raising, and for retry_after seconds afterwards they are returned
+    without waiting for the API. Older or missing responses are fetched
+    while the caller waits.
+
+    With a store (e.g. SQLiteStore) responses are kept across runs, so a
+    restarted process can serve them while the API is down. They expire from
+    it when they are too old to be returned at all:
+
+        cached = api.read_through(store=SQLiteStore('responses.db'), deadline=2)
+        data = cached.GET('/1/locations/1')
+
+    Cached data is shared, callers must not modify it.
+    """
+
+    def __init__(self, api, fresh=60, stale_while_revalidate=300, stale_if_error=86400,
+            retry_after=10, maxsize=1024, store=None, workers=2, deadline=None,
+            clock=time.time):
+        self.api = api
+        self.fresh = fresh
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.retry_after = retry_after
+        self.workers = workers
+        self.deadline = deadline
+        self.clock = clock
+        # older responses can't be returned any more
+        ttl = fresh + max(stale_while_revalidate, stale_if_error)
+        self.cache = Cache(maxsize=maxsize, ttl=ttl, store=store, clock=clock)
+        if store is not None and hasattr(store, 'expire'):
+            store.expire(clock())
+        self.hits = 0
+        self.stale_hits = 0
+        self.error_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+        self._failing_until = None
+        self._queued = deque()
+        self._refreshing = set()
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def GET(self, url):
+        """Return the decoded response to a GET of url, possibly stale"""
+        now = self.clock()
+        entry = self.cache.get(url)
+        if entry is not None:
+            age = now - entry[0]
+            if age <= self.fresh:
+                self._count('hits')
+                return entry[1]
+            if age <= self.fresh + self.stale_while_revalidate:
+                self._count('stale_hits')
+                self._revalidate(url)
+                return entry[1]
+            failing_until = self._failing_until
+            if (failing_until is not None and now < failing_until
+                    and age <= self.fresh + self.stale_if_error):
+                self._count('error_hits')
+                self._revalidate(url)
+                return entry[1]
+        self._count('misses')
+        try:
+            return self._fetch(url)
+        except APIError:
+            # the API answered
+            raise
+        except Exception:
+            self._failed()
+            if entry is None or now - entry[0] > self.fresh + self.stale_if_error:
+                raise
+            if self.api.logger is not None:
+                self.api.logger.warn('GET %s failed, returning stale data', url, exc_info=True)
+            self._count('error_hits')
+            return entry[1]
+
+    def _fetch(self, url):
+        kw = {}
+        if self.deadline is not None:
+            kw['deadline'] = self.deadline
+        data = self.api.GET(url, **kw)
+        self.cache.set(url, [self.clock(), data])
+        with self._cond:
+            self._failing_until = None
+        return data
+
+    def _failed(self):
+        with self._cond:
+            self.errors += 1
+            self._failing_until = self.clock() + self.retry_after
+
+    def _count(self, name):
+        with self._cond:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _revalidate(self, url):
+        with self._cond:
+            if self._closed or url in self._refreshing:
+                return
+            self._refreshing.add(url)
+            self._queued.append(url)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queued and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                urls = list(self._queued)
+                self._queued.clear()
+            for url in _imap(self._refresh, urls, self.workers):
+                with self._cond:
+                    self._refreshing.discard(url)
+
+    def _refresh(self, url):
+        try:
+            self._fetch(url)
+        except Exception:
+            self._failed()
+            if self.api.logger is not None:
+                self.api.logger.warn('Refreshing %s failed', url, exc_info=True)
+        else:
+            self._count('refreshes')
+        return url
+
+    def close(self):
+        """Stop refreshing in the background, queued refreshes are dropped"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def stats(self):
+        """Return a dict with the number of fresh, stale and stale on error
+        responses returned, of misses, background refreshes and failed
+        requests."""
+        with self._cond:
+            return dict(
+                    hits=self.hits,
+                    stale_hits=self.stale_hits,
+                    error_hits=self.error_hits,
+                    misses=self.misses,
+                    refreshes=self.refreshes,
+                    errors=self.errors)
+
+
+def _process_response(handler, url, body, content_type, decode):
+    if decode and body and content_type is not None \
+            and content_type.split(';')[0].strip() == 'application/json':
+        body = _deserialize(body, content_type)
+    return handler(url, body)
+
+class ProcessPipeline(object):
+    """Fetch responses in threads and handle them in a pool of processes.
+
+    This spreads CPU heavy decoding and handling of responses over several
+    cores while network I/O continues in the fetching threads:
+
+        def handler(url, data):
+            ...
+
+        with ProcessPipeline(api, handler) as pipeline:
+            for result in pipeline.run(urls):
+                ...
+
+    handler is called in a worker process with the url and the response
+    body, decoded if it is JSON and decode is True, raw bytes otherwise. It
+    must be picklable, i.e. a module level function, and so must its result.
+
+    At most max_pending responses are held waiting for a process, fetching
+    pauses when that many are pending.
+    """
+
+    def __init__(self, api, handler, processes=None, fetchers=4, max_pending=None, decode=True):
+        import multiprocessing
+        self.api = api
+        self.handler = handler
+        self.fetchers = fetchers
+        if max_pending is None:
+            max_pending = 2 * (processes or multiprocessing.cpu_count())
+        self.max_pending = max_pending
+        self.decode = decode
+        self._pool = multiprocessing.Pool(processes)
+
+    def _fetch(self, url):
+        response = self.api.request('GET', url, handler=self.api.handle_raw)
+        content_type = self.api._get_header('Content-Type', response['headers'])
+        return url, response['body'], content_type
+
+    def run(self, urls):
+        """Fetch and handle every url, yielding the results of handler in order"""
+        pending = deque()
+        for url, body, content_type in _imap(self._fetch, urls, self.fetchers):
+            pending.append(self._pool.apply_async(_process_response,
+                (self.handler, url, body, content_type, self.decode)))
+            while len(pending) >= self.max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+def _body_digest(body):
+    import hashlib
+    if body is None:
+        return None
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.sha1(body).hexdigest()
+
+class _ReplayResponse(object):
+    """A recorded response, readable like an http.client response"""
+
+    def __init__(self, status, reason, headers, body, read_delay=0.0, sleep=time.sleep):
+        import io
+        self.status = status
+        self.reason = reason
+        self._headers = headers
+        self._size = len(body)
+        self._body = io.BytesIO(body)
+        self._read_delay = read_delay
+        self._sleep = sleep
+
+    def getheaders(self):
+        return [tuple(h) for h in self._headers]
+
+    def getheader(self, name, default=None):
+        return _Headers(self._headers).get(name, default)
+
+    def read(self, amt=None):
+        data = self._body.read() if amt is None else self._body.read(amt)
+        if data and self._read_delay:
+            # spread the transfer time over the reads
+            self._sleep(self._read_delay * len(data) / self._size)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def isclosed(self):
+        return self._body.closed or self._body.tell() == self._size
+
+    def close(self):
+        self._body.close()
+
+
+class _RecordingConnection(object):
+
+    def __init__(self, recorder, conn):
+        self._recorder = recorder
+        self._conn = conn
+        self._exchange = None
+
+    def _get_timeout(self):
+        return self._conn.timeout
+
+    def _set_timeout(self, timeout):
+        self._conn.timeout = timeout
+
+    timeout = property(_get_timeout, _set_timeout)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def request(self, method, url, body=None, headers=None):
+        self._exchange = dict(
+                method=method,
+                url=url,
+                request_digest=_body_digest(body),
+                started=time.time())
+        self._conn.request(method, url, body=body, headers=headers)
+
+    def getresponse(self):
+        exchange, self._exchange = self._exchange, None
+        resp = self._conn.getresponse()
+        exchange['ttfb'] = time.time() - exchange['started']
+        body = resp.read()
+        exchange['elapsed'] = time.time() - exchange.pop('started')
+        exchange['status'] = resp.status
+        exchange['reason'] = resp.reason
+        exchange['headers'] = [list(h) for h in resp.getheaders()]
+        self._recorder._record(exchange, body)
+        return _ReplayResponse(resp.status, resp.reason, exchange['headers'], body)
+
+    def close(self):
+        self._conn.close()
+
+
+class Recorder(object):
+    """A conn_factory that records all HTTP exchanges to a file.
+
+    The exchanges (including headers, bodies and timings) are written as
+    gzipped JSON lines and can be replayed with Replayer:
+
+        recorder = Recorder('traffic.jsonl.gz')
+        api = API('api.metropublisher.com', credentials, conn_factory=recorder)
+        ...
+        recorder.close()
+
+    Request bodies are not recorded, only a digest used to match them when
+    replaying.
+    """
+
+    def __init__(self, path, conn_factory=None):
+        import gzip
+        if conn_factory is None:
+            conn_factory = _default_conn_factory()
+        self.conn_factory = conn_factory
+        self._file = gzip.open(path, 'wb')
+        self._lock = threading.Lock()
+
+    def __call__(self, host, **kw):
+        return _RecordingConnection(self, self.conn_factory(host, **kw))
+
+    def _record(self, exchange, body):
+        import base64
+        exchange['body'] = base64.b64encode(body).decode('ascii')
+        line = (_json_dumps(exchange, sort_keys=True) + '\n').encode('utf-8')
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class _ReplayConnection(object):
+
+    sock = None
+    timeout = None
+
+    def __init__(self, replayer, host):
+        self._replayer = replayer
+        self.host = host
+        self._request = None
+
+    def request(self, method, url, body=None, headers=None):
+        self._request = (method, url, _body_digest(body))
+
+    def getresponse(self):
+        request, self._request = self._request, None
+        return self._replayer._response(request)
+
+    def close(self):
+        pass
+
+
+class Replayer(object):
+    """A conn_factory that replays exchanges recorded by Recorder.
+
+    Requests are matched to recorded responses by method, url and body.
+    Responses for the same request are replayed in the order they were
+    recorded, the last one is repeated once the others are used up.
+
+    The recorded time to first byte and transfer time are simulated, scaled
+    by time_scale (0 for no delays). A fixed latency (seconds to first byte)
+    and bandwidth (bytes per second) can be given instead. An unrecorded
+    request raises LookupError.
+    """
+
+    def __init__(self, path, latency=None, bandwidth=None, time_scale=1.0, sleep=time.sleep):
+        import gzip
+        import base64
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.time_scale = time_scale
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._exchanges = {}
+        f = gzip.open(path, 'rb')
+        try:
+            for line in f:
+                exchange = _json_loads(line.decode('utf-8'))
+                exchange['body'] = base64.b64decode(exchange['body'].encode('ascii'))
+                key = (exchange['method'], exchange['url'], exchange['request_digest'])
+                self._exchanges.setdefault(key, deque()).append(exchange)
+        finally:
+            f.close()
+
+    def __call__(self, host, **kw):
+        return _ReplayConnection(self, host)
+
+    def _response(self, request):
+        with self._lock:
+            exchanges = self._exchanges.get(request)
+            if not exchanges:
+                raise LookupError('No recorded response for %s %s' % request[:2])
+            if len(exchanges) > 1:
+                exchange = exchanges.popleft()
+            else:
+                exchange = exchanges[0]
+        latency = self.latency
+        if latency is None:
+            latency = exchange['ttfb'] * self.time_scale
+        if latency:
+            self.sleep(latency)
+        body = exchange['body']
+        if self.bandwidth is not None:
+            read_delay = len(body) / float(self.bandwidth)
+        else:
+            read_delay = (exchange['elapsed'] - exchange['ttfb']) * self.time_scale
+        return _ReplayResponse(
+                exchange['status'],
+                exchange['reason'],
+                exchange['headers'],
+                body,
+                read_delay,
+                self.sleep)
+
+
+def _atomic_write(path, data):
+    """Replace the contents of the file at path with data (bytes)"""
+    import os
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+class SyncEvent(namedtuple('SyncEvent', 'kind url item')):
+    """A change found by CollectionSync.
+
+    kind is 'added', 'changed' or 'removed', item is the record of the item
+    (None for removed items).
+    """
+
+
+class CollectionSync(object):
+    """Find the changes to a collection since the last run.
+
+    Instead of listing the whole collection, only items modified since the
+    last run are requested (passing the last modified time seen as the
+    since_param query parameter). Deleted items are found with a cheap listing
+    of only the item urls.
+
+    The state (last modified time and known urls) is kept in a JSON file at
+    state_path:
+
+        sync = CollectionSync(api, '/1/locations', 'locations.state')
+        for event in sync.run():
+            print(event.kind, event.url)
+
+    The state is only saved once all events were consumed, so an
+    interrupted run is repeated on the next run. fields are the fields of the
+    items in the events, url and modified_field are always included. rpp is
+    the page size, by default api.rpp_tuner chooses it.
+    """
+
+    def __init__(self, api, url, state_path, fields=None, modified_field='modified',
+            since_param='modified_after', rpp=None):
+        self.api = api
+        self.url = url
+        self.state_path = state_path
+        self.modified_field = modified_field
+        self.since_param = since_param
+        self.rpp = rpp
+        fields = list(fields or [])
+        for f in [modified_field, 'url']:
+            if f not in fields:
+                fields.insert(0, f)
+        self.fields = fields
+
+    def load_state(self):
+        try:
+            f = open(self.state_path, 'rb')
+        except IOError:
+            return dict(high_water=None, high_water_urls=[], urls=[])
+        try:
+            return _json_loads(f.read().decode('utf-8'))
+        finally:
+            f.close()
+
+    def save_state(self, state):
+        _atomic_write(self.state_path, _json_dumps(state, sort_keys=True).encode('utf-8'))
+
+    def _items(self, fields, params=None):
+        query = Query.parse(self.url).with_fields(fields).with_rpp(self.rpp)
+        if params:
+            query = query.filter(**dict(params))
+        for page in self.api.iter_pages(query, lazy=True):
+            for record in page.records():
+                yield record
+
+    def run(self, detect_deletions=True):
+        """Yield a SyncEvent for every item added, changed or removed since the last run"""
+        state = self.load_state()
+        urls = set(state['urls'])
+        high_water = state['high_water']
+        high_water_urls = set(state['high_water_urls'])
+        params = []
+        if high_water is not None:
+            params.append((self.since_param, high_water))
+        new_high_water = high_water
+        new_high_water_urls = set(high_water_urls)
+        for item in self._items(self.fields, params):
+            modified = getattr(item, self.modified_field)
+            if modified == high_water and item.url in high_water_urls:
+                # seen in the last run already
+                continue
+            if item.url in urls:
+                yield SyncEvent('changed', item.url, item)
+            else:
+                urls.add(item.url)
+                yield SyncEvent('added', item.url, item)
+            if modified is None:
+                continue
+            if new_high_water is None or modified > new_high_water:
+                new_high_water = modified
+                new_high_water_urls = set([item.url])
+            elif modified == new_high_water:
+                new_high_water_urls.add(item.url)
+        if detect_deletions and state['urls']:
+            current = set(item.url for item in self._items(['url']))
+            for url in sorted(urls - current):
+                urls.discard(url)
+                new_high_water_urls.discard(url)
+                yield SyncEvent('removed', url, None)
+        self.save_state(dict(
+                high_water=new_high_water,
+                high_water_urls=sorted(new_high_water_urls),
+                urls=sorted(urls)))
+
+
+class _HashingFile(object):
+    """Wrap a file, computing the digest and size of the data written"""
+
+    def __init__(self, f, algorithm):
+        self.f = f
+        self.algorithm = algorithm
+        self.truncate(0)
+
+    def seek(self, offset):
+        self.f.seek(offset)
+
+    def truncate(self, size):
+        import hashlib
+        assert size == 0, 'Can only be truncated entirely'
+        self.f.truncate(0)
+        self.hash = hashlib.new(self.algorithm)
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        self.f.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class BlobStore(object):
+    """A content addressed, deduplicated store for downloaded files.
+
+    Files are stored under root by the digest of their content, so a file
+    downloaded from several urls is only stored once. An index remembers the
+    digest, size and ETag of every url downloaded:
+
+        store = BlobStore('media')
+        digest = store.download(api, file_info['download_url'], size=file_info['size'])
+        data = store.open(digest)
+
+    A download is skipped if the expected etag (or, without one, size) matches
+    the stored file. Otherwise, if the url was downloaded before, it is
+    requested conditionally with If-None-Match. Files are hashed while they
+    are written, they are never read back.
+    """
+
+    def __init__(self, root, algorithm='sha256'):
+        import os
+        self.root = root
+        self.algorithm = algorithm
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.index = SQLiteStore(os.path.join(root, 'index.sqlite'), table='blobs')
+        self.downloaded = 0
+        self.skipped = 0
+        self.not_modified = 0
+        self.deduplicated = 0
+        self.bytes_downloaded = 0
+
+    def path(self, digest):
+        import os
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def __contains__(self, digest):
+        import os
+        return os.path.exists(self.path(digest))
+
+    def lookup(self, url):
+        """Return the index entry (digest, size and etag) for url, or None"""
+        entry = self.index.get(url)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def download(self, api, url, size=None, etag=None, **kw):
+        """Download url into the store and return the digest of its content.
+
+        size and etag are what is expected of the file, e.g. from its metadata.
+        Further keyword arguments are passed to api.request.
+        """
+        import os
+        import tempfile
+        entry = self.lookup(url)
+        if entry is not None and entry['digest'] in self:
+            if (etag is not None and entry['etag'] == etag) \
+                    or (etag is None and size is not None and entry['size'] == size):
+                self.skipped += 1
+                return entry['digest']
+            if entry['etag'] is not None:
+                kw['headers'] = dict(kw.get('headers') or {}, **{'If-None-Match': entry['etag']})
+        kw['deadline'] = deadline = api._get_deadline(kw.get('deadline'))
+        fd, tmp = tempfile.mkstemp(dir=self.root)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                outfile = _HashingFile(f, self.algorithm)
+                response = api.request('GET', url,
+                        http_handler=_WriteToFile(outfile, deadline),
+                        handler=api.handle_raw,
+                        **kw)
+            finally:
+                f.close()
+            if response['status'] == 304:
+                self.not_modified += 1
+                return entry['digest']
+            digest = outfile.hexdigest()
+            self.downloaded += 1
+            self.bytes_downloaded += outfile.size
+            path = self.path(digest)
+            if os.path.exists(path):
+                self.deduplicated += 1
+            else:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                os.replace(tmp, path)
+                tmp = None
+        finally:
+            if tmp is not None:
+                os.unlink(tmp)
+        self.index.set(url, dict(
+                digest=digest,
+                size=outfile.size,
+                etag=api._get_header('ETag', response['headers'])), None)
+        return digest
+
+    def open(self, digest):
+        """Return the content of a file as a read only memory map.
+
+        The data is not copied into memory, the map can be sliced like bytes.
+        """
+        import os
+        import mmap
+        f = open(self.path(digest), 'rb')
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                # empty files cannot be mapped
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def close(self):
+        self.index.close()
+
+
+class _TokenBucket(object):
+    """Limit the rate of something (e.g. bytes per second) across threads"""
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = rate if burst is None else burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        """Take n tokens, sleeping until the rate allows it"""
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            self.sleep(wait)
+
+class DownloadResult(namedtuple('DownloadResult', 'url path size error')):
+    """The outcome of downloading url to path. error is the exception if the
+    download failed."""
+
+    __slots__ = ()
+
+class DownloadStats(object):
+    """Progress of a DownloadManager run"""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started = clock()
+        self.files = 0
+        self.done = 0
+        self.failed = 0
+        self.received = 0
+        self._sizes = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed(self):
+        return self.clock() - self.started
+
+    @property
+    def rate(self):
+        """Bytes received per second"""
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.0
+        return self.received / elapsed
+
+    @property
+    def total(self):
+        """Size of all files, None if it is not known yet"""
+        if len(self._sizes) < self.files or None in self._sizes.values():
+            return None
+        return sum(self._sizes.values())
+
+    @property
+    def position(self):
+        """Bytes of all files on disk"""
+        return sum(self._positions.values())
+
+    def eta(self):
+        """Seconds until all files are downloaded at the current rate, None
+        if that is not known."""
+        total = self.total
+        rate = self.rate
+        if total is None or rate <= 0:
+            return None
+        return max(0.0, (total - self.position) / rate)
+
+    def _expect(self, key, size):
+        with self._lock:
+            self._sizes[key] = size
+
+    def _progress(self, key, position, received):
+        with self._lock:
+            self._positions[key] = position
+            self.received += received
+
+    def __str__(self):
+        eta = self.eta()
+        return '%s/%s files, %s failed, %.1f MB in %.1fs (%.2f MB/s), ETA %s' % (
+                self.done, self.files, self.failed, self.received / 1e6, self.elapsed,
+                self.rate / 1e6, '?' if eta is None else '%.0fs' % eta)
+
+def _content_range_start(value):
+    """Return the first byte position of a Content-Range header"""
+    return int(value.split()[1].split('-')[0])
+
+class _DownloadWriter(object):
+    """http_handler streaming a 200 or 206 response into outfile"""
+
+    def __init__(self, manager, stats, key, outfile, offset, deadline=None):
+        self.manager = manager
+        self.stats = stats
+        self.key = key
+        self.outfile = outfile
+        self.offset = offset
+        self.deadline = deadline
+
+    def __call__(self, request, resp):
+        headers = _getheaders(resp)
+        response = dict(status=resp.status, headers=headers, body=None, reason=resp.reason)
+        if resp.status == 200:
+            offset = 0
+        elif resp.status == 206:
+            offset = _content_range_start(headers.get('Content-Range'))
+            if offset > self.offset:
+                raise ValueError('Server skipped bytes %s-%s' % (self.offset, offset))
+        else:
+            response['body'] = _read_body(resp, self.deadline)
+            return response
+        length = headers.get('Content-Length')
+        if length is not None:
+            self.stats._expect(self.key, offset + int(length))
+        # we may be retried, so start over from offset
+        self.outfile.seek(offset)
+        self.outfile.truncate(offset)
+        position = offset
+        bandwidth = self.manager._bandwidth
+        while True:
+            data = resp.read(65536)
+            if not data:
+                break
+            if self.deadline is not None:
+                self.deadline.timeout()
+            if bandwidth is not None:
+                bandwidth.consume(len(data))
+            self.outfile.write(data)
+            position += len(data)
+            self.stats._progress(self.key, position, len(data))
+        self.outfile.flush()
+        # resp.read(amt) returns b'' if the connection closes early
+        if length is not None and position != offset + int(length):
+            raise ConnectionError('Connection closed after %s of %s bytes' % (
+                position - offset, length))
+        return response
+
+class DownloadManager(object):
+    """Download many files concurrently.
+
+        manager = DownloadManager(api, workers=8, bandwidth=10 * 2**20)
+        results = manager.download([(info['download_url'], path, info['size'])
+                for info, path in files], progress=print)
+
+    At most workers downloads run at once, and at most per_host of them from
+    one host. bandwidth caps the bytes per second received by all of them.
+
+    URLs on the API host are requested through api. Files on other hosts
+    (e.g. a CDN) are downloaded through a connection pool per host, with the
+    timeouts and TLS settings of api but without its access token.
+
+    Each file is written to path + '.part' and renamed to path when it is
+    complete. Failed downloads are retried up to retries times, resuming
+    with a Range request from what was already received. .part files left
+    by an interrupted run are resumed as well.
+
+    download() returns a DownloadResult per file rather than raising errors.
+    progress is called with the DownloadStats when a file is done.
+    """
+
+    def __init__(self, api, workers=4, per_host=2, bandwidth=None, retries=3, clock=time.time,
+            sleep=time.sleep):
+        self.api = api
+        self.workers = workers
+        self.per_host = per_host
+        self.retries = retries
+        self.clock = clock
+        self._bandwidth = None
+        if bandwidth is not None:
+            self._bandwidth = _TokenBucket(bandwidth, sleep=sleep)
+        self._hosts = {}
+        self._conns = {}
+        self._lock = threading.Lock()
+        self.stats = None
+
+    def _host(self, url):
+        """Return (host slots, connection or None for the API) for url"""
+        from urllib.parse import urlsplit
+        conn = self.api.conn
+        host = urlsplit(url).netloc or conn.host
+        with self._lock:
+            slots = self._hosts.get(host)
+            if slots is None:
+                slots = self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            if host == conn.host:
+                other = None
+            else:
+                other = self._conns.get(host)
+                if other is None:
+                    other = self._conns[host] = _HTTPConnection(host,
+                            conn_factory=conn._conn_factory,
+                            logger=conn.logger,
+                            connect_timeout=conn.connect_timeout,
+                            read_timeout=conn.read_timeout,
+                            pool_size=self.per_host,
+                            tls=conn.tls,
+                            dns=conn.dns)
+        try:
+            (other or conn)._get_path(url)
+        except AssertionError:
+            raise ValueError(str(sys.exc_info()[1]))
+        return slots, other
+
+    def download(self, jobs, progress=None):
+        """Download (url, path) or (url, path, size) jobs, return a list of
+        DownloadResults in the same order."""
+        jobs = [tuple(job) + (None,) * (3 - len(job)) for job in jobs]
+        self.stats = stats = DownloadStats(self.clock)
+        stats.files = len(jobs)
+        for i, (url, path, size) in enumerate(jobs):
+            stats._expect(i, size)
+        def fetch(job):
+            result = self._fetch(stats, *job)
+            if progress is not None:
+                progress(stats)
+            return result
+        try:
+            return list(_imap(fetch, [(i,) + job for i, job in enumerate(jobs)], self.workers))
+        finally:
+            with self._lock:
+                conns, self._conns = self._conns, {}
+            for conn in conns.values():
+                conn.close()
+
+    def _fetch(self, stats, key, url, path, size):
+        import os
+        part = path + '.part'
+        attempt = 0
+        try:
+            slots, conn = self._host(url)
+        except ValueError:
+            # e.g. an unsupported scheme, retrying won't help
+            with stats._lock:
+                stats.failed += 1
+            return DownloadResult(url, path, None, sys.exc_info()[1])
+        while True:
+            try:
+                with slots:
+                    size = self._fetch_once(stats, key, url, part, conn)
+                os.replace(part, path)
+            except APIError:
+                error = sys.exc_info()[1]
+            except Exception:
+                error = sys.exc_info()[1]
+                attempt += 1
+                if attempt <= self.retries:
+                    if self.api.logger is not None:
+                        self.api.logger.warn('Download of %s failed, resuming', url, exc_info=True)
+                    continue
+            else:
+                with stats._lock:
+                    stats.done += 1
+                return DownloadResult(url, path, size, None)
+            with stats._lock:
+                stats.failed += 1
+            return DownloadResult(url, path, None, error)
+
+    def _handle(self, request, response):
+        if response['status'] in (200, 206, 416):
+            return response
+        return self.api.handle(request, response)
+
+    def _fetch_once(self, stats, key, url, part, conn=None):
+        import os
+        fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o666)
+        with os.fdopen(fd, 'r+b') as f:
+            offset = f.seek(0, os.SEEK_END)
+            stats._progress(key, offset, 0)
+            headers = None
+            if offset:
+                headers = {'Range': 'bytes=%s-' % offset}
+            deadline = self.api._get_deadline(None)
+            writer = _DownloadWriter(self, stats, key, f, offset, deadline)
+            if conn is None:
+                response = self.api.request('GET', url, http_handler=writer,
+                        handler=self._handle, headers=headers, deadline=deadline)
+            else:
+                kw = {}
+                if deadline is not None:
+                    kw['deadline'] = deadline
+                response = conn.http_retry('GET', url, headers=headers or {},
+                        http_handler=writer, handler=self._handle, **kw)
+            if response['status'] == 416:
+                # the file changed since the .part file was written
+                f.truncate(0)
+                raise ValueError('Range not satisfiable, restarting download of %s' % url)
+            return f.tell()
+
+
+class PriorityClass(object):
+    """A class of requests for a Scheduler.
+
+    Requests of classes with a lower priority number go first. At most
+    max_in_flight requests of the class run at once (None for no limit).
+    """
+
+    def __init__(self, priority, max_in_flight=None):
+        self.priority = priority
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.completed = 0
+        self.wait_time = 0.0
+
+    def has_capacity(self):
+        return self.max_in_flight is None or self.in_flight < self.max_in_flight
+
+
+class _Waiter(object):
+
+    def __init__(self, priority_class):
+        self.priority_class = priority_class
+        self.granted = False
+        self.cancelled = False
+        self.event = threading.Event()
+
+
+class Scheduler(object):
+    """Run requests through a shared API in order of priority.
+
+    At most max_in_flight requests (by default the connection pool size of
+    api) run at once. When a slot frees up, it goes to the waiting request of
+    the highest priority class that is below its own max_in_flight:
+
+        scheduler = Scheduler(api)
+        scheduler.GET('interactive', '/1/sections')
+        scheduler.request('bulk', 'PUT', url, data)
+
+    The default classes are 'interactive' and 'bulk', bulk requests never
+    take more than half of the slots so some are left for interactive ones.
+    """
+
+    def __init__(self, api, max_in_flight=None, classes=None):
+        import heapq
+        import itertools
+        self.api = api
+        if max_in_flight is None:
+            max_in_flight = api.conn.pool_size
+        self.max_in_flight = max_in_flight
+        if classes is None:
+            classes = {
+                    'interactive': PriorityClass(0),
+                    'bulk': PriorityClass(10, max(1, max_in_flight // 2))}
+        self.classes = classes
+        self.in_flight = 0
+        self._heapq = heapq
+        self._counter = itertools.count()
+        self._waiting = []
+        self._lock = threading.Lock()
+
+    def _can_run(self, priority_class):
+        return self.in_flight < self.max_in_flight and priority_class.has_capacity()
+
+    def _grant(self, priority_class):
+        self.in_flight += 1
+        priority_class.in_flight += 1
+
+    def _dispatch(self):
+        """Hand free slots to the waiting requests, highest priority first"""
+        skipped = []
+        while self._waiting and self.in_flight < self.max_in_flight:
+            item = self._heapq.heappop(self._waiting)
+            waiter = item[2]
+            if waiter.cancelled:
+                continue
+            if not waiter.priority_class.has_capacity():
+                skipped.append(item)
+                continue
+            self._grant(waiter.priority_class)
+            waiter.granted = True
+            waiter.event.set()
+        for item in skipped:
+            self._heapq.heappush(self._waiting, item)
+
+    def _acquire(self, priority_class, deadline):
+        with self._lock:
+            if not self._waiting and self._can_run(priority_class):
+                self._grant(priority_class)
+                return
+            waiter = _Waiter(priority_class)
+            self._heapq.heappush(self._waiting,
+                    (priority_class.priority, next(self._counter), waiter))
+            self._dispatch()
+        started = time.time()
+        if deadline is None:
+            waiter.event.wait()
+        else:
+            waiter.event.wait(max(0, deadline.remaining()))
+        with self._lock:
+            priority_class.wait_time += time.time() - started
+            if not waiter.granted:
+                waiter.cancelled = True
+                raise DeadlineExceeded('Deadline exceeded waiting to be scheduled')
+
+    def _release(self, priority_class):
+        with self._lock:
+            self.in_flight -= 1
+            priority_class.in_flight -= 1
+            priority_class.completed += 1
+            self._dispatch()
+
+    def _call(self, priority_class, func, *args, **kw):
+        priority_class = self.classes[priority_class]
+        kw['deadline'] = deadline = self.api._get_deadline(kw.get('deadline'))
+        self._acquire(priority_class, deadline)
+        try:
+            return func(*args, **kw)
+        finally:
+            self._release(priority_class)
+
+    def request(self, priority_class, method, url, *args, **kw):
+        """Like API.request, but wait for a slot for priority_class first.
+
+        A deadline, if given, includes the time spent waiting.
+        """
+        return self._call(priority_class, self.api.request, method, url, *args, **kw)
+
+    def GET(self, priority_class, url, **kw):
+        """Like API.GET, but wait for a slot for priority_class first"""
+        return self._call(priority_class, self.api.GET, url, **kw)
+
+    def waiting(self):
+        """Return the number of requests waiting for a slot"""
+        with self._lock:
+            return len([w for p, c, w in self._waiting if not w.cancelled])
+
+
+class WriteResult(namedtuple('WriteResult', 'method url writes result error')):
+    """The outcome of sending a coalesced write.
+
+    writes is the number of queued writes it stands for. If the request
+    failed, error is the exception and result is None.
+    """
+
+    __slots__ = ()
+
+def _merge_write(queued, method, data):
+    """Combine a queued (method, data, writes) with a new write"""
+    if queued is None or method == 'PUT':
+        writes = 1 if queued is None else queued[2] + 1
+        return method, data, writes
+    queued_method, queued_data, writes = queued
+    if not isinstance(queued_data, dict) or not isinstance(data, dict):
+        raise TypeError('Only dicts can be merged into a queued write')
+    merged = dict(queued_data)
+    merged.update(data)
+    return queued_method, merged, writes + 1
+
+class WriteBehind(object):
+    """Queue PUT and PATCH requests and send them in batches.
+
+    While queued, writes to the same URL are coalesced: a PUT replaces what
+    was queued before, a PATCH is merged into the queued PATCH or PUT. The
+    merge is a shallow dict update, so PATCH data must be a dict.
+
+    Queued writes are sent by workers threads when the oldest of them is
+    max_delay seconds old, when writes to max_pending URLs are queued, or by
+    flush() and close(). Writes to one URL are sent in the order they were
+    made. Errors are not raised, but reported in the WriteResults passed to
+    callback and returned by flush().
+
+        writes = api.write_behind(max_delay=2)
+        writes.PATCH('/1/locations/1', {'title': 'New title'})
+        ...
+        api.close()  # sends the remaining writes
+    """
+
+    def __init__(self, api, max_delay=1.0, max_pending=100, workers=4, callback=None,
+            clock=time.time):
+        self.api = api
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.workers = workers
+        self.callback = callback
+        self.clock = clock
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self._pending = {}
+        self._oldest = None
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+
+    def PUT(self, url, data):
+        """Queue a PUT of data to url"""
+        self._queue('PUT', url, data)
+
+    def PATCH(self, url, data):
+        """Queue a PATCH of url with data, a dict"""
+        self._queue('PATCH', url, data)
+
+    def _queue(self, method, url, data):
+        with self._cond:
+            if self._closed:
+                raise ValueError('WriteBehind is closed')
+            self._pending[url] = _merge_write(self._pending.get(url), method, data)
+            self.queued += 1
+            if self._oldest is None:
+                self._oldest = self.clock()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._oldest is None:
+                        self._cond.wait()
+                        continue
+                    remaining = self._oldest + self.max_delay - self.clock()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closed:
+                    return
+            self.flush()
+
+    def _send(self, write):
+        method, url, data, writes = write
+        try:
+            result = self.api.request(method, url, data)
+        except Exception:
+            return WriteResult(method, url, writes, None, sys.exc_info()[1])
+        return WriteResult(method, url, writes, result, None)
+
+    def flush(self):
+        """Send all queued writes now, return their WriteResults"""
+        with self._flush_lock:
+            with self._cond:
+                pending, self._pending = self._pending, {}
+                self._oldest = None
+            writes = [(method, url, data, n) for url, (method, data, n) in pending.items()]
+            results = list(_imap(self._send, writes, self.workers))
+            with self._cond:
+                self.sent += len(results)
+                self.failed += len([r for r in results if r.error is not None])
+        if self.callback is not None:
+            for result in results:
+                self.callback(result)
+        return results
+
+    def close(self):
+        """Send the queued writes and stop, return their WriteResults"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        return self.flush()
+
+    def stats(self):
+        """Return a dict with the number of writes queued, requests sent (and
+        failed among them), writes saved by coalescing and writes pending."""
+        with self._cond:
+            pending = sum(n for method, data, n in self._pending.values())
+            return dict(
+                    queued=self.queued,
+                    sent=self.sent,
+                    failed=self.failed,
+                    coalesced=self.queued - pending - self.sent,
+                    pending=pending)